@@ -15,11 +15,17 @@
 # Partly based on/inspired from: https://github.com/chop-dbhi/dicom-anon
 
 import pydicom
-from pydicom.filereader import dcmread
+from pydicom.filereader import dcmread, read_partial
 from pydicom.errors import InvalidDicomError
 from pydicom.tag import Tag
+from pydicom.datadict import tag_for_keyword
 from pydicom.dataelem import DataElement
-from functools import partial
+from pydicom.dataset import Dataset
+from pydicom.uid import UID, DeflatedExplicitVRLittleEndian, ExplicitVRLittleEndian, ImplicitVRLittleEndian
+from pydicom.filewriter import write_dataset, write_file_meta_info
+from pydicom.filebase import DicomBytesIO
+from functools import partial, lru_cache
+from collections import Counter, namedtuple
 import io
 import os
 import argparse
@@ -28,13 +34,33 @@ import logging
 import re
 import sqlite3
 import hashlib
+import hmac
+import heapq
+import zlib
 import shutil
+import select
+import struct
+import json
+import socket
+import socketserver
+import time
+import ctypes
+import ctypes.util
+import cProfile
+import pstats
 from signal import signal, SIGINT
-from sys import exit
-from threading import Thread, Lock
+from secrets import token_hex
+from sys import exit, platform, _current_frames
+from threading import Thread, Lock, BoundedSemaphore, Event, current_thread, get_ident
 from queue import Queue, Empty
 from tqdm import tqdm
 
+# NumPy is only needed for pixel screening and masking
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 
 INDEXED_LOCK_FNAME = 'indexed.lock'
 TABLE_EXISTS = 'SELECT name FROM sqlite_master WHERE name=?'
@@ -45,12 +71,100 @@ INSERT = 'INSERT OR IGNORE INTO %s (original) VALUES (?)' % TABLE_NAME
 UPDATE = 'UPDATE %s SET serial = ? WHERE original = ?' % TABLE_NAME
 GET = 'SELECT serial FROM %s WHERE original = ?' % TABLE_NAME
 SEARCH = 'SELECT original FROM %s WHERE original LIKE ?' % TABLE_NAME
+GET_SERIALS = 'SELECT serial FROM %s WHERE serial IS NOT NULL' % TABLE_NAME
+GET_UNLINKED = 'SELECT original FROM %s WHERE serial IS NULL' % TABLE_NAME
 
 HASH_TABLE_NAME = 'fingerprints'
 CREATE_HASH_TABLE = 'CREATE TABLE %s (id INTEGER PRIMARY KEY AUTOINCREMENT, hash, UNIQUE(hash))' % HASH_TABLE_NAME
 INSERT_HASH = 'INSERT OR IGNORE INTO %s (hash) VALUES (?)' % HASH_TABLE_NAME
 GET_HASH = 'SELECT hash FROM %s WHERE hash = ?' % HASH_TABLE_NAME
 
+ITEM_HEADER = struct.Struct('<HHL')
+SEQUENCE_DELIMITER = (0xFFFE, 0xE0DD)
+UNDEFINED_LENGTH = 0xFFFFFFFF
+EXTRA_LENGTH_VRS = (b'OB', b'OD', b'OF', b'OL', b'OW', b'SQ', b'UC', b'UN', b'UR', b'UT')
+LARGE_FILE_SIZE = 256  # megabytes
+COPY_CHUNK_SIZE = 65536
+DEFLATE_LEVEL = 6
+STUCK_EXIT_CODE = 3  # a timed out worker holds a lock that all workers need
+PER_FILE_COST = 65536  # bytes, approximate overhead of processing a file regardless of its size
+SCHEDULES = ('walk', 'size')
+DEFLATABLE_SYNTAXES = (ImplicitVRLittleEndian, ExplicitVRLittleEndian)
+PIXEL_DATA_HEADER = struct.Struct('<HH2s2xL')
+
+DICOM_PREFIX = b'DICM'
+DICOM_PREAMBLE_LENGTH = 128
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_ISDIR = 0x40000000
+INOTIFY_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+INOTIFY_EVENT = struct.Struct('iIII')
+
+FILES_TABLE_NAME = 'indexed_files'
+CREATE_FILES_TABLE = 'CREATE TABLE %s (path PRIMARY KEY, size, mtime)' % FILES_TABLE_NAME
+INSERT_FILE = 'INSERT OR REPLACE INTO %s (path, size, mtime) VALUES (?, ?, ?)' % FILES_TABLE_NAME
+GET_FILES = 'SELECT path, size, mtime FROM %s' % FILES_TABLE_NAME
+
+LINKS_TABLE_NAME = 'links'
+CREATE_LINKS_TABLE = 'CREATE TABLE %s (invitation PRIMARY KEY, serial, original)' % LINKS_TABLE_NAME
+INSERT_LINK = 'INSERT OR REPLACE INTO %s (invitation, serial, original) VALUES (?, ?, ?)' % LINKS_TABLE_NAME
+GET_LINKS = 'SELECT invitation, serial, original FROM %s' % LINKS_TABLE_NAME
+
+UID_TABLE_NAME = 'uids'
+CREATE_UID_TABLE = 'CREATE TABLE %s (original PRIMARY KEY, pseudonym)' % UID_TABLE_NAME
+INSERT_UID = 'INSERT OR IGNORE INTO %s (original, pseudonym) VALUES (?, ?)' % UID_TABLE_NAME
+GET_UID = 'SELECT pseudonym FROM %s WHERE original = ?' % UID_TABLE_NAME
+WORK_TABLE_NAME = 'work_units'
+CREATE_WORK_TABLE = 'CREATE TABLE IF NOT EXISTS %s (id INTEGER PRIMARY KEY, job, tasks, owner, expires, done DEFAULT 0)' % \
+                    WORK_TABLE_NAME
+COUNT_REMAINING_WORK = 'SELECT COUNT(*) FROM %s WHERE job = ? AND done = 0' % WORK_TABLE_NAME
+DELETE_FINISHED_WORK = 'DELETE FROM %s WHERE job NOT IN (SELECT job FROM %s WHERE done = 0)' % \
+                       (WORK_TABLE_NAME, WORK_TABLE_NAME)
+INSERT_WORK = 'INSERT INTO %s (job, tasks) VALUES (?, ?)' % WORK_TABLE_NAME
+LEASE_WORK = 'UPDATE %s SET owner = ?, expires = ? WHERE id = (SELECT id FROM %s WHERE job = ? AND done = 0 AND ' \
+             '(owner IS NULL OR expires < ?) ORDER BY id LIMIT 1)' % (WORK_TABLE_NAME, WORK_TABLE_NAME)
+GET_LEASED_WORK = 'SELECT id, tasks FROM %s WHERE job = ? AND owner = ? AND done = 0 ORDER BY id LIMIT 1' % \
+                  WORK_TABLE_NAME
+RENEW_LEASES = 'UPDATE %s SET expires = ? WHERE owner = ? AND done = 0' % WORK_TABLE_NAME
+COMPLETE_WORK = 'UPDATE %s SET done = 1 WHERE id = ? AND owner = ?' % WORK_TABLE_NAME
+WORK_UNIT_SIZE = 100  # files
+LEASE_TIME = 300.0  # seconds a work unit is leased for, renewed while it is processed
+INDEX_TIMEOUT = 60.0  # seconds to wait for other processes to release the index
+
+UID_ROOT = '2.25.'
+UID_CACHE_SIZE = 65536
+
+MANIFEST_TABLE_NAME = 'manifest'
+MANIFEST_FIELDS = ('input_path', 'fingerprint', 'output_path', 'output_hash', 'serial', 'status', 'reason', 'seconds')
+CREATE_MANIFEST_TABLE = 'CREATE TABLE IF NOT EXISTS %s (%s)' % (MANIFEST_TABLE_NAME, ', '.join(MANIFEST_FIELDS))
+INSERT_MANIFEST = 'INSERT INTO %s VALUES (%s)' % (MANIFEST_TABLE_NAME, ', '.join('?' for _ in MANIFEST_FIELDS))
+MANIFEST_BATCH_SIZE = 1000
+
+SCREEN_SIZE = 256  # pixels, frames are downsampled to at most this size for screening
+SCREEN_TILE = 16  # pixels of the downsampled frame
+SCREEN_THRESHOLD = 0.85  # fraction of the range of a frame from which pixels count as bright
+SCREEN_DENSITY = 0.1  # fraction of pixels in a tile that change between bright and dark along rows and columns
+SCREEN_DARK = 0.15  # fraction of the range of a frame up to which pixels count as background
+SCREEN_BACKGROUND = 0.5  # fraction of background pixels in a text-like tile
+SCREEN_BORDER = 0.2  # fraction of the frame along each side that is screened
+SCREEN_MIN_TILES = 2  # text-like tiles for a frame to be suspicious
+SCREEN_BATCH_FRAMES = 64
+
+LISTING_FIELDS = ('root', 'directory', 'filename', 'size', 'mtime')
+CRAWL_WORKERS = 8
+
+AUTOSCALE_INTERVAL = 2.0  # seconds between samples
+AUTOSCALE_MIN_GAIN = 0.05  # relative throughput gain needed to keep an added worker
+CPU_SATURATION = 0.9  # fraction of AUTOSCALE_CPUS in use from which workers are removed
+AUTOSCALE_CPUS = 1  # CPUs the worker threads can keep busy, one since they mostly hold the GIL
+AUTOSCALE_MAX_BACKOFF = 32  # samples to wait at most before adding a worker again
+
+PROFILE_INTERVAL = 0.005  # seconds between samples of the stacks of worker threads
+PROFILE_TOP = 20  # functions in the hotspot table
+
 REMOVED_TEXT = 'Removed by dicom-pseudon'
 DE_IDENTIFICATION_METHOD = 'Pseudonymized by The Cancer Registry of Norway'
 
@@ -63,6 +177,28 @@ IMAGE_TYPE = (0x8, 0x8)
 MANUFACTURER = (0x8, 0x70)
 MANUFACTURER_MODEL_NAME = (0x8, 0x1090)
 PIXEL_DATA = (0x7FE0, 0x10)
+PIXEL_DATA_TAG = Tag(PIXEL_DATA)
+
+# Checks (from https://wiki.cancerimagingarchive.net/download/attachments/
+# 3539047/pixel-checker-filter.script?version=1&modificationDate=1333114118541&api=v2):
+# - ImageType to ensure it does not contain the word SAVE to avoid screen saves/captures
+# - Manufacturer to ensure it's not NAI, http://www.naitechproducts.com/dicombox.html
+# - Manufacturer to ensure it's not PACSGEAR, http://www.pacsgear.com/
+# - Series Description to ensure it does not contain the word SAVE to avoid screen saves/captures
+# - Manufacturer to ensure it's not NAI, http://www.naitechproducts.com/dicombox.html
+# - If BurnedInAnnotation contains YES
+# Rules are (tag, predicate, value, reason), and the first matching rule decides the reason.
+DEFAULT_QUARANTINE_RULES = [
+  (SERIES_DESCR, 'contains', 'patient protocol', 'patient protocol'),
+  (SERIES_DESCR, 'contains', 'save', 'Likely screen capture'),
+  (MODALITY, 'not_in_modalities', '', 'modality not allowed'),
+  (MODALITY, 'missing', '', 'Modality missing'),
+  (BURNT_IN, 'in', 'yes|y', 'burnt-in data'),
+  (IMAGE_TYPE, 'contains', 'save', 'Likely screen capture'),
+  (MANUFACTURER, 'contains', 'north american imaging, inc', 'Manufacturer is suspect'),
+  (MANUFACTURER, 'contains', 'pacsgear', 'Manufacturer is suspect'),
+  (MANUFACTURER_MODEL_NAME, 'contains', 'the dicom box', 'Manufacturer model name is suspect'),
+]
 
 ALLOWED_FILE_META = {  # Attributes taken from https://github.com/dicom/ruby-dicom
   MEDIA_STORAGE_SOP_INSTANCE_UID: 1,
@@ -117,6 +253,10 @@ PIXEL_MODULE_TAGS = {  # Attributes taken from http://dicom.nema.org/medical/Dic
   (0x28, 0x7FE0): 1, # Pixel Data Provider URL
 }
 
+# Result of pseudonymizing a single dataset in memory. Data holds the cleaned
+# DICOM file as bytes, and is None if the dataset should be quarantined.
+PseudonymizeResult = namedtuple('PseudonymizeResult', 'data quarantined reason serial')
+
 logger = logging.getLogger('dicom_pseudon')
 logger.setLevel(logging.INFO)
 
@@ -124,7 +264,7 @@ logger.setLevel(logging.INFO)
 class Index(object):
 
     def __init__(self, filename):
-        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.db = sqlite3.connect(filename, timeout=INDEX_TIMEOUT, check_same_thread=False)
         self.cursor = self.db.cursor()
 
     def close(self):
@@ -153,6 +293,20 @@ class Index(object):
         if len(results):
             return results[0][0]
 
+    def serials(self):
+        if not self.table_exists(TABLE_NAME):
+            return set()
+
+        self.cursor.execute(GET_SERIALS)
+        return set(row[0] for row in self.cursor.fetchall())
+
+    def unlinked(self):
+        if not self.table_exists(TABLE_NAME):
+            return []
+
+        self.cursor.execute(GET_UNLINKED)
+        return [row[0] for row in self.cursor.fetchall()]
+
     def insert(self, original):
         if not self.table_exists(TABLE_NAME):
             with self.db as db:
@@ -182,328 +336,1898 @@ class Index(object):
         with self.db as db:
             db.execute(INSERT_HASH, (hash,))
 
+    def get_uid(self, original):
+        if not self.table_exists(UID_TABLE_NAME):
+            return None
 
-class DicomPseudon(object):
-    def __init__(self, white_list_file, **kwargs):
-        self.white_list_file = white_list_file
-        self.index_file = kwargs.get('index_file', 'index.db')
-        self.quarantine = kwargs.get('quarantine', 'quarantine')
-        self.log_file = kwargs.get('log_file', 'dicom_pseudon.log')
-        self.modalities = [string.lower() for string in kwargs.get('modalities', ['mr', 'ct'])]
-        skip_first_line = kwargs.get('white_list_skip_first_line', False)
-        is_test = kwargs.get('is_test', False)
+        self.cursor.execute(GET_UID, (original,))
+        results = self.cursor.fetchall()
+        if len(results):
+            return results[0][0]
+
+    def insert_uid(self, original, pseudonym):
+        if not self.table_exists(UID_TABLE_NAME):
+            with self.db as db:
+                db.execute(CREATE_UID_TABLE)
 
+        with self.db as db:
+            db.execute(INSERT_UID, (original, pseudonym,))
+
+    def create_work_units(self, job, units):
+        with self.db as db:
+            db.execute(CREATE_WORK_TABLE)
+
+        # Only the first process creates the work units of a job, and removes those of jobs that are done.
+        # Later processes join the job while it has units left, a job that is done is created again.
+        self.db.execute('BEGIN IMMEDIATE')
         try:
-            content = self.load_white_list(white_list_file, skip_first_line)
-            self.white_list = self.parse_white_list(content)
-        except IOError:
-            raise Exception('Could not open white list file.')
+            if self.db.execute(COUNT_REMAINING_WORK, (job,)).fetchone()[0] == 0:
+                self.db.execute(DELETE_FINISHED_WORK)
+                self.db.executemany(INSERT_WORK, [(job, unit) for unit in units])
+            self.db.commit()
+        except sqlite3.Error:
+            self.db.rollback()
+            raise
+
+    def remaining_work_units(self, job):
+        if not self.table_exists(WORK_TABLE_NAME):
+            return 0
+
+        self.cursor.execute(COUNT_REMAINING_WORK, (job,))
+        return self.cursor.fetchone()[0]
+
+    def lease_work_unit(self, job, owner, lease_time):
+        # Units that were never leased come first, then units with an expired lease
+        now = time.time()
+        with self.db as db:
+            db.execute(LEASE_WORK, (owner, now + lease_time, job, now,))
 
-        self.index = Index(self.index_file)
+        self.cursor.execute(GET_LEASED_WORK, (job, owner,))
+        results = self.cursor.fetchall()
+        if len(results):
+            return results[0]
 
-        # Skip logging handlers for tests
-        if is_test:
-            return
+    def renew_leases(self, owner, lease_time):
+        with self.db as db:
+            db.execute(RENEW_LEASES, (time.time() + lease_time, owner,))
 
-        logger.handlers = []
-        if not self.log_file:
-            self.log = logging.StreamHandler()
-        else:
-            self.log = logging.FileHandler(self.log_file)
+    def complete_work_unit(self, unit_id, owner):
+        # Returns False if the lease expired and the unit was leased by another process
+        with self.db as db:
+            return db.execute(COMPLETE_WORK, (unit_id, owner,)).rowcount == 1
 
-        self.log.setLevel(logging.INFO)
-        formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-        self.log.setFormatter(formatter)
-        logger.addHandler(self.log)
+    def indexed_files(self):
+        if not self.table_exists(FILES_TABLE_NAME):
+            return {}
 
-    def close_all(self):
-        if self.log_file:
-            self.log.flush()
-            self.log.close()
-        self.index.close()
+        self.cursor.execute(GET_FILES)
+        return dict((path, (size, mtime)) for path, size, mtime in self.cursor.fetchall())
 
-    @staticmethod
-    def destination(source, dest, root):
-        if dest.startswith(root):
-            raise Exception('Destination directory cannot be inside or equal to source directory')
-        if not source.startswith(root):
-            raise Exception('The file to be moved must be in the root directory')
-        return os.path.normpath(dest)
+    def insert_indexed_files(self, entries):
+        if not self.table_exists(FILES_TABLE_NAME):
+            with self.db as db:
+                db.execute(CREATE_FILES_TABLE)
 
-    def quarantine_file(self, filepath, ident_dir, reason):
-        full_quarantine_dir = self.destination(filepath, self.quarantine, ident_dir)
-        if not os.path.exists(full_quarantine_dir):
-            os.makedirs(full_quarantine_dir)
-        quarantine_name = os.path.join(full_quarantine_dir, os.path.basename(filepath))
-        logger.info('%s will be moved to quarantine directory due to: %s' % (filepath, reason))
-        shutil.copyfile(filepath, quarantine_name)
+        with self.db as db:
+            db.executemany(INSERT_FILE, entries)
 
-    # Checks (from https://wiki.cancerimagingarchive.net/download/attachments/
-    # 3539047/pixel-checker-filter.script?version=1&modificationDate=1333114118541&api=v2):
-    # - ImageType to ensure it does not contain the word SAVE to avoid screen saves/captures
-    # - Manufacturer to ensure it's not NAI, http://www.naitechproducts.com/dicombox.html
-    # - Manufacturer to ensure it's not PACSGEAR, http://www.pacsgear.com/
-    # - Series Description to ensure it does not contain the word SAVE to avoid screen saves/captures
-    # - Manufacturer to ensure it's not NAI, http://www.naitechproducts.com/dicombox.html
-    # - If BurnedInAnnotation contains YES
-    def check_quarantine(self, ds):
-        if SERIES_DESCR in ds and ds[SERIES_DESCR].value is not None:
-            series_desc = ds[SERIES_DESCR].value.strip().lower()
-            if 'patient protocol' in series_desc:
-                return True, 'patient protocol'
-            elif 'save' in series_desc:
-                return True, 'Likely screen capture'
-
-        if MODALITY in ds:
-            modality = ds[MODALITY]
-            if modality.VM == 1:
-                modality = [modality.value]
-            for m in modality:
-                if m is None or not m.lower() in self.modalities:
-                    return True, 'modality not allowed'
-
-        if MODALITY not in ds:
-            return True, 'Modality missing'
-
-        if BURNT_IN in ds and ds[BURNT_IN].value is not None:
-            burnt_in = ds[BURNT_IN].value
-            if burnt_in.strip().lower() in ['yes', 'y']:
-                return True, 'burnt-in data'
-
-        if IMAGE_TYPE in ds:
-            image_type = ds[IMAGE_TYPE]
-            if image_type.VM == 1:
-                image_type = [image_type.value]
-            for i in image_type:
-                if i is not None and 'save' in i.strip().lower():
-                    return True, 'Likely screen capture'
-
-        if MANUFACTURER in ds:
-            manufacturer = ds[MANUFACTURER].value.strip().lower()
-            if 'north american imaging, inc' in manufacturer or 'pacsgear' in manufacturer:
-                return True, 'Manufacturer is suspect'
-
-        if MANUFACTURER_MODEL_NAME in ds:
-            model_name = ds[MANUFACTURER_MODEL_NAME].value.strip().lower()
-            if 'the dicom box' in model_name:
-                return True, 'Manufacturer model name is suspect'
+    def links(self):
+        if not self.table_exists(LINKS_TABLE_NAME):
+            return {}
 
-        return False, ''
+        self.cursor.execute(GET_LINKS)
+        return dict((invitation, (serial, original)) for invitation, serial, original in self.cursor.fetchall())
 
-    @staticmethod
-    def load_white_list(fn, skip_first_line=False):
-        with open(fn, 'r') as f:
-            reader = csv.reader(f)
-            if skip_first_line is True:
-                next(f, None)
-            return [','.join(row) for row in reader]
+    def insert_links(self, links):
+        if not self.table_exists(LINKS_TABLE_NAME):
+            with self.db as db:
+                db.execute(CREATE_LINKS_TABLE)
 
+        with self.db as db:
+            db.executemany(INSERT_LINK, links)
 
-    @staticmethod
-    def parse_white_list(content):
-        values = {}
-        for tag in content:
-            a, b = re.sub(r'[\(\)]', '', tag).split(',')
-            t = (int(a, 16), int(b, 16))
-            values[t] = 1
-        return values
 
-    @staticmethod
-    def buffer_fingerprint(filepath, buffer):
-        hash = hashlib.md5()
-        with open(filepath, 'rb') as f:
-            for chunk in iter(lambda: f.read(65536), b''):
-                hash.update(chunk)
-                buffer.write(chunk)
-        return hash.hexdigest()
+class HashingWriter(object):
 
-    def white_list_handler(self, e):
-        value = self.white_list.get((e.tag.group, e.tag.element), None)
-        if value:
-            return True
-        return False
+    def __init__(self, f):
+        self.f = f
+        self.hash = hashlib.md5()
 
-    def index_built(self):
-        return os.path.exists(INDEXED_LOCK_FNAME)
+    def write(self, data):
+        self.hash.update(data)
+        return self.f.write(data)
 
-    def input_yes_or_no_prompt(self, question):
-        while True:
-            answer = input('%s [y/n] ' % question)
-            if answer == 'y':
-                return True
-            elif answer == 'n':
-                return False
-            else:
-                print("I didn't get that. Please enter 'y' (yes) or 'n' (no).")
+    def hexdigest(self):
+        return self.hash.hexdigest()
 
-    def prompt_skip_build_index(self):
-        return self.input_yes_or_no_prompt('Index for search table found. Skip indexing?')
 
-    def prompt_skip_prior(self, dir_name):
-        return self.input_yes_or_no_prompt('Some files in %s have been pseudonymized before. Skip already pseudonymized files?' % dir_name)
+class Manifest(object):
+    """Records one row per processed file. Rows are written by a background
+    thread in batches, to a SQLite database if the file name ends with .db,
+    and to a CSV file otherwise. Existing manifests are appended to."""
 
-    def fingerprints_exist(self):
-        return self.index.table_exists(HASH_TABLE_NAME)
+    def __init__(self, filename, batch_size=MANIFEST_BATCH_SIZE):
+        self.filename = filename
+        self.batch_size = batch_size
+        self.statuses = Counter()
+        self.reasons = Counter()
+        self.lock = Lock()
+        self.queue = Queue()
+        self.thread = Thread(target=self.writer)
+        self.thread.daemon = True
+        self.thread.start()
 
-    def register_fingerprint(self, fingerprint, db_lock):
+    def add(self, row):
         try:
-            db_lock.acquire()
-            self.index.insert_hash(fingerprint)
+            self.lock.acquire()
+            self.statuses[row[5]] += 1
+            if row[6]:
+                self.reasons[row[6]] += 1
         finally:
-            db_lock.release()
+            self.lock.release()
+        self.queue.put(row)
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+    def next_batch(self):
+        batch = [self.queue.get()]
+        while batch[-1] is not None and len(batch) < self.batch_size:
+            try:
+                batch.append(self.queue.get_nowait())
+            except Empty:
+                break
+        return batch
+
+    def writer(self):
+        if self.filename.endswith('.db'):
+            db = sqlite3.connect(self.filename)
+            with db:
+                db.execute(CREATE_MANIFEST_TABLE)
+            write = lambda rows: db.executemany(INSERT_MANIFEST, rows)
+            flush = db.commit
+            close = db.close
+        else:
+            is_new = not os.path.exists(self.filename) or os.path.getsize(self.filename) == 0
+            f = open(self.filename, 'a', newline='')
+            writer = csv.writer(f)
+            if is_new:
+                writer.writerow(MANIFEST_FIELDS)
+            write = writer.writerows
+            flush = f.flush
+            close = f.close
 
-    def fingerprint_exists(self, fingerprint, db_lock):
         try:
-            db_lock.acquire()
-            if self.index.get_hash(fingerprint) is not None:
-                return True
-            return False
+            while True:
+                batch = self.next_batch()
+                done = batch[-1] is None
+                rows = batch[:-1] if done else batch
+                if rows:
+                    write(rows)
+                    flush()
+                if done:
+                    break
         finally:
-            db_lock.release()
+            close()
 
-    def clean(self, ds, e):
-        cleaned = None
-        white_listed = self.white_list_handler(e)
 
-        if not white_listed:
-            t = (e.tag.group, e.tag.element)
-            if REQUIRED_TAGS.get(t, None):
-                cleaned = ''
-            elif PIXEL_MODULE_TAGS.get(t, None):
-                return True
-            else:
-                del ds[e.tag]
-                cleaned = REMOVED_TEXT
+class WorkerPool(object):
+    """Worker threads taking tasks from a shared queue. Workers can be added
+    while the pool is running, and are removed by asking one of them to
+    retire before it takes its next task. Workers get the pool as their last
+    argument and call should_retire() before every queue.get()."""
 
-        if cleaned is not None and e.tag in ds and ds[e.tag].value is not None:
-            ds[e.tag].value = cleaned
+    def __init__(self, target, args, queue):
+        self.target = target
+        self.args = args
+        self.queue = queue
+        self.size = 0
+        self.retiring = 0
+        self.threads = []
+        self.lock = Lock()
 
-        # Tell our caller if we left this element intact
-        return white_listed
+    def start(self, num_workers):
+        for _ in range(num_workers):
+            self.grow()
 
-    def clean_meta(self, ds, e):
-        white_listed = self.white_list_handler(e)
+    def grow(self):
+        t = Thread(target=self.target, args=self.args + (self,))
+        t.daemon = True
+        try:
+            self.lock.acquire()
+            if self.retiring:
+                # Cancel a pending retirement instead of starting a new thread
+                self.retiring -= 1
+                return
+            self.size += 1
+            self.threads.append(t)
+        finally:
+            self.lock.release()
+        t.start()
 
-        if ALLOWED_FILE_META.get((e.tag.group, e.tag.element), None):
+    def replace(self, thread):
+        # Starts a new worker in place of one that is stuck and will not take another task
+        t = Thread(target=self.target, args=self.args + (self,))
+        t.daemon = True
+        try:
+            self.lock.acquire()
+            if thread in self.threads:
+                self.threads.remove(thread)
+            self.threads.append(t)
+        finally:
+            self.lock.release()
+        t.start()
+
+    def shrink(self):
+        try:
+            self.lock.acquire()
+            if self.size - self.retiring > 1:
+                self.retiring += 1
+        finally:
+            self.lock.release()
+
+    @property
+    def active(self):
+        return self.size - self.retiring
+
+    def should_retire(self):
+        try:
+            self.lock.acquire()
+            if not self.retiring:
+                return False
+            self.retiring -= 1
+            self.size -= 1
+            return True
+        finally:
+            self.lock.release()
+
+    def stop(self):
+        try:
+            self.lock.acquire()
+            remaining = self.size
+        finally:
+            self.lock.release()
+        for _ in range(remaining):
+            self.queue.put(None)
+        for t in self.threads:
+            t.join()
+
+
+class Autoscaler(object):
+    """Resizes a WorkerPool between min_workers and max_workers. Every interval
+    seconds the throughput (files per second, from the progress bar), the
+    number of queued tasks and the CPU time used by the process are sampled.
+    A worker is added while there is work queued and CPU to spare, and is
+    removed again if that did not raise the throughput, or if the CPUs are
+    saturated. CPU usage is relative to cpu_count CPUs: reading and cleaning
+    files holds the GIL, so the workers of one process saturate about one CPU
+    however many the host has."""
+
+    def __init__(self, pool, pbar, min_workers, max_workers, interval=AUTOSCALE_INTERVAL, cpu_count=AUTOSCALE_CPUS):
+        self.pool = pool
+        self.pbar = pbar
+        self.min_workers = min_workers
+        self.max_workers = max_workers
+        self.interval = interval
+        self.cpu_count = cpu_count
+        self.cooldown = 0
+        self.backoff = 1
+        self.stopped = Event()
+        self.thread = Thread(target=self.monitor)
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    @staticmethod
+    def cpu_time():
+        times = os.times()
+        return times.user + times.system
+
+    def sample(self, last):
+        now, done, cpu = time.time(), self.pbar.n, self.cpu_time()
+        elapsed = max(now - last[0], 1e-6)
+        throughput = (done - last[1]) / elapsed
+        cpu_usage = (cpu - last[2]) / elapsed / self.cpu_count
+        return (now, done, cpu), throughput, cpu_usage
+
+    def decide(self, throughput, last_throughput, cpu_usage, queued, last_action):
+        workers = self.pool.active
+        # No worker is added for cooldown samples, counting this one
+        cooling = self.cooldown > 0
+        if cooling:
+            self.cooldown -= 1
+        if last_action == 'grow':
+            if throughput < last_throughput * (1 + AUTOSCALE_MIN_GAIN):
+                # The added worker did not help, wait longer every time before trying again
+                self.cooldown = self.backoff
+                self.backoff = min(self.backoff * 2, AUTOSCALE_MAX_BACKOFF)
+                return 'shrink' if workers > self.min_workers else None
+            self.backoff = 1
+        if cpu_usage >= CPU_SATURATION and workers > self.min_workers:
+            return 'shrink'
+        if queued > workers and cpu_usage < CPU_SATURATION and workers < self.max_workers and not cooling:
+            return 'grow'
+        return None
+
+    def monitor(self):
+        last = (time.time(), self.pbar.n, self.cpu_time())
+        last_throughput = 0
+        last_action = None
+        while not self.stopped.wait(self.interval):
+            last, throughput, cpu_usage = self.sample(last)
+            action = self.decide(throughput, last_throughput, cpu_usage, self.pool.queue.qsize(), last_action)
+            if action == 'grow':
+                self.pool.grow()
+            elif action == 'shrink':
+                self.pool.shrink()
+            if action:
+                logger.info('%s to %d workers (%.1f files/s, %d%% CPU, %d queued)' %
+                            ('Growing' if action == 'grow' else 'Shrinking', self.pool.active,
+                             throughput, cpu_usage * 100, self.pool.queue.qsize()))
+            last_throughput = throughput
+            last_action = action
+
+
+class OwnedLock(object):
+    """A Lock that remembers which thread holds it, so that the watchdog can
+    tell whether an abandoned worker still holds it."""
+
+    def __init__(self):
+        self.lock = Lock()
+        self.owner = None
+
+    def acquire(self, blocking=True, timeout=-1):
+        if not self.lock.acquire(blocking, timeout):
             return False
-        if not white_listed:
-            del ds[e.tag]
-        return white_listed
+        self.owner = get_ident()
+        return True
 
-    def pseudonymize(self, ds, db_lock):
-        accession_num = ds.AccessionNumber
+    def release(self):
+        self.owner = None
+        self.lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+
+class Watchdog(object):
+    """Limits the time a worker thread may spend on a single file. Threads
+    cannot be interrupted, so a worker that exceeds the limit is abandoned:
+    on_timeout is called with the file and the context the worker registered
+    it with, so that the task can be finished on its behalf and the worker
+    replaced. A worker calls finish() before it commits the result of a file;
+    from then on the file can no longer time out, and if the file timed out
+    first, finish() tells the worker to discard its result. When an abandoned
+    worker returns from the file, end() tells it to stop."""
+
+    def __init__(self, time_limit, on_timeout):
+        self.time_limit = time_limit
+        self.on_timeout = on_timeout
+        self.active = {}
+        self.abandoned = set()
+        self.timeouts = 0
+        self.lock = Lock()
+        self.thread = Thread(target=self.monitor)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def begin(self, path, context):
         try:
-            db_lock.acquire()
-            serial_num = self.index.get(accession_num)
+            self.lock.acquire()
+            self.active[get_ident()] = [path, time.time(), current_thread(), context, None]
         finally:
-            db_lock.release()
+            self.lock.release()
 
-        if serial_num is None:
-            raise ValueError('No serial number for accession number %s' % (accession_num,))
+    def claim_output(self, path):
+        # Output that is removed again if the file times out
+        try:
+            self.lock.acquire()
+            entry = self.active.get(get_ident())
+            if entry is not None:
+                entry[4] = path
+        finally:
+            self.lock.release()
 
-        # Fix file meta data portion
-        if MEDIA_STORAGE_SOP_INSTANCE_UID in ds.file_meta:
-            ds.file_meta[MEDIA_STORAGE_SOP_INSTANCE_UID].value = ds.SOPInstanceUID
+    def finish(self):
+        # Returns False if the file timed out, otherwise the file can no longer time out
+        try:
+            self.lock.acquire()
+            if get_ident() in self.abandoned:
+                return False
+            self.active.pop(get_ident(), None)
+            return True
+        finally:
+            self.lock.release()
 
-        ds.file_meta.walk(self.clean_meta)
-        ds.walk(partial(self.clean))
+    def end(self):
+        # Returns False if the worker was abandoned, and has to stop
+        try:
+            self.lock.acquire()
+            if get_ident() in self.abandoned:
+                return False
+            self.active.pop(get_ident(), None)
+            return True
+        finally:
+            self.lock.release()
 
-        return ds, serial_num
+    def is_abandoned(self):
+        return get_ident() in self.abandoned
 
-    def build_index_worker(self, ident_dir, queue, pbar, db_lock):
+    def monitor(self):
         while True:
-            task = queue.get()
-            if task is None:
-                break
-
-            root, filename = task
+            time.sleep(min(1.0, self.time_limit / 4.0))
+            now = time.time()
             try:
-                if filename.startswith('.'):
-                    continue
-                source_path = os.path.join(root, filename)
-                ds = None
-                try:
-                    ds = dcmread(source_path, stop_before_pixels=True)
-                except IOError:
-                    logger.error('Error reading file %s' % source_path)
-                    self.close_all()
-                    return False
-                except InvalidDicomError:  # DICOM formatting error
-                    continue
+                self.lock.acquire()
+                expired = [(ident, entry) for ident, entry in self.active.items() if now - entry[1] > self.time_limit]
+                for ident, _ in expired:
+                    del self.active[ident]
+                    self.abandoned.add(ident)
+                self.timeouts += len(expired)
+            finally:
+                self.lock.release()
+
+            for _, (path, started, thread, context, output) in expired:
                 try:
-                    db_lock.acquire()
-                    self.index.insert(ds.AccessionNumber)
-                finally:
-                    db_lock.release()
+                    self.on_timeout(path, started, thread, context, output)
+                except Exception as err:
+                    logger.error('Could not handle timeout of %s: %s' % (path, err))
+
+
+class Profiler(object):
+    """Profiles worker threads. Every worker runs under its own cProfile
+    profile, and the stacks of all workers are sampled by a single thread.
+    report() aggregates the profiles of all workers that have finished so far,
+    and writes them as <output>.prof (pstats) and the samples as
+    <output>.collapsed (collapsed stacks, as read by flamegraph.pl)."""
+
+    def __init__(self, output, hotspots=(), interval=PROFILE_INTERVAL):
+        self.output = output
+        self.interval = interval
+        # Functions that are always in the hotspot table, if they were called
+        self.hotspots = set((f.__code__.co_filename, f.__code__.co_firstlineno, f.__code__.co_name) for f in hotspots)
+        self.profiles = []
+        self.samples = Counter()
+        self.threads = set()
+        self.lock = Lock()
+        self.thread = None
+
+    def wrap(self, target):
+        def profiled(*args):
+            profile = self.start()
+            try:
+                return target(*args)
             finally:
-                queue.task_done()
-                pbar.update()
+                self.stop(profile)
+        return profiled
 
-    def build_index(self, ident_dir, links_file, delimiter=',', skip_first_line=False, num_workers=1):
-        logger.info('Indexing accession numbers to search index')
+    def start(self):
+        try:
+            self.lock.acquire()
+            self.threads.add(get_ident())
+            if self.thread is None:
+                self.thread = Thread(target=self.sample)
+                self.thread.daemon = True
+                self.thread.start()
+        finally:
+            self.lock.release()
 
-        db_lock = Lock()
-        queue = Queue()
-        file_count = sum(len(files) for _, _, files in os.walk(ident_dir))
-        pbar = tqdm(total=file_count)
-        pbar.set_description('Indexing acc. numbers')
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError as err:
+            # Only one profile can be enabled at a time from Python 3.12, the thread is still sampled
+            logger.warning('Could not profile worker thread: %s' % err)
+            return None
+        return profile
 
-        for root, _, files in os.walk(ident_dir):
-            for filename in files:
-                queue.put((root, filename,))
+    def stop(self, profile):
+        if profile is not None:
+            profile.disable()
+        try:
+            self.lock.acquire()
+            self.threads.discard(get_ident())
+            if profile is not None:
+                self.profiles.append(profile)
+        finally:
+            self.lock.release()
 
-        threads = []
-        for _ in range(num_workers):
-            t = Thread(target=self.build_index_worker,
-                       args=(ident_dir, queue, pbar, db_lock,))
-            threads.append(t)
-            t.daemon = True
-            t.start()
+    def sample(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.lock.acquire()
+                threads = list(self.threads)
+            finally:
+                self.lock.release()
+            if not threads:
+                continue
+
+            frames = _current_frames()
+            stacks = []
+            for ident in threads:
+                frame = frames.get(ident)
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append('%s (%s:%d)' % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+                    frame = frame.f_back
+                if stack:
+                    stacks.append(';'.join(reversed(stack)))
+            del frames
 
-        queue.join()
+            try:
+                self.lock.acquire()
+                self.samples.update(stacks)
+            finally:
+                self.lock.release()
 
-        for _ in range(num_workers):
-            queue.put(None)
-        for t in threads:
-            t.join()
+    def report(self, top=PROFILE_TOP):
+        try:
+            self.lock.acquire()
+            profiles = list(self.profiles)
+            samples = Counter(self.samples)
+        finally:
+            self.lock.release()
 
-        pbar.close()
+        with open(self.output + '.collapsed', 'w') as f:
+            for stack, count in sorted(samples.items()):
+                f.write('%s %d\n' % (stack, count))
+        logger.info('Profile: wrote %d samples to %s.collapsed' % (sum(samples.values()), self.output))
 
-        # Keep track of potential duplicates in links file
-        invitation_num_set = set()
+        if not profiles:
+            return None
+        stats = pstats.Stats(profiles[0])
+        for profile in profiles[1:]:
+            stats.add(profile)
+        stats.dump_stats(self.output + '.prof')
+        logger.info('Profile: wrote profiles of %d workers to %s.prof' % (len(profiles), self.output))
+
+        # Times are summed over all workers
+        own = sorted(stats.stats, key=lambda func: stats.stats[func][2], reverse=True)[:top]
+        funcs = set(own) | (self.hotspots & set(stats.stats))
+        logger.info('Profile: %-56s %10s %10s %10s %10s' % ('function', 'calls', 'own s', 'cumul. s', 'ms/call'))
+        for func in sorted(funcs, key=lambda func: stats.stats[func][3], reverse=True):
+            _, calls, own_time, cumulative, _ = stats.stats[func]
+            filename, line, name = func
+            label = '%s (%s:%d)' % (name, os.path.basename(filename), line) if line else name
+            logger.info('Profile: %-56s %10d %10.3f %10.3f %10.3f' %
+                        (label[:56], calls, own_time, cumulative, 1000.0 * cumulative / calls if calls else 0.0))
+        return stats
+
+
+class QuarantineRules(object):
+    """Quarantine rules compiled into one evaluator, which looks up every tag
+    that is referenced by the rules once. Supported predicates are missing,
+    contains, equals, in and not_in (with values separated by |), and
+    not_in_modalities (the allowed modalities)."""
+
+    def __init__(self, rules, modalities):
+        self.by_tag = {}
+        for priority, (tag, predicate, value, reason) in enumerate(rules):
+            test = self.compile_predicate(predicate, value.strip().lower(), modalities)
+            self.by_tag.setdefault(Tag(tag), []).append((priority, test, reason))
+        self.tags = sorted(self.by_tag.keys())
 
-        # Count lines in links file
-        with open(links_file, 'r') as f:
-            if skip_first_line is True:
+    @staticmethod
+    def compile_predicate(predicate, value, modalities):
+        if predicate == 'missing':
+            return lambda values: values is None
+        if predicate == 'contains':
+            return lambda values: values is not None and any(v is not None and value in v for v in values)
+        if predicate == 'equals':
+            return lambda values: values is not None and value in values
+        if predicate in ('in', 'not_in', 'not_in_modalities'):
+            if predicate == 'not_in_modalities':
+                allowed = set(modalities)
+            else:
+                allowed = set(v.strip() for v in value.split('|'))
+            if predicate == 'in':
+                return lambda values: values is not None and any(v in allowed for v in values)
+            return lambda values: values is not None and any(v is None or v not in allowed for v in values)
+        raise Exception('Unknown quarantine rule predicate %s' % predicate)
+
+    @staticmethod
+    def parse_tag(tag):
+        keyword_tag = tag_for_keyword(tag.strip())
+        if keyword_tag is not None:
+            return keyword_tag
+        return int(re.sub(r'[\(\),\s]', '', tag), 16)
+
+    @staticmethod
+    def load(fn, skip_first_line=False):
+        with open(fn, 'r') as f:
+            if skip_first_line is True:
                 next(f, None)
-            reader = csv.reader(f, delimiter=delimiter)
-            line_count = len(list(reader))
+            reader = csv.reader(f)
+            rules = []
+            for row in reader:
+                if not row:
+                    continue
+                line = reader.line_num + (1 if skip_first_line is True else 0)
+                if len(row) != 4:
+                    raise Exception('Quarantine rule on line %d of %s has %d fields, expected tag, predicate, value '
+                                    'and reason' % (line, fn, len(row)))
+                tag, predicate, value, reason = row
+                try:
+                    tag = QuarantineRules.parse_tag(tag)
+                except ValueError:
+                    raise Exception('Unknown tag %s in quarantine rule on line %d of %s' % (tag, line, fn))
+                rules.append((tag, predicate.strip(), value, reason.strip()))
+            return rules
+
+    @staticmethod
+    def values(ds, tag):
+        if tag not in ds:
+            return None
+        e = ds[tag]
+        values = e.value if e.VM > 1 else [e.value]
+        return [None if v is None else str(v).strip().lower() for v in values]
+
+    def evaluate(self, ds):
+        match = None
+        for tag in self.tags:
+            values = self.values(ds, tag)
+            for priority, test, reason in self.by_tag[tag]:
+                if (match is None or priority < match[0]) and test(values):
+                    match = (priority, reason)
+        if match is None:
+            return False, ''
+        return True, match[1]
+
+
+class UIDRemapper(object):
+    """Replaces UIDs with UIDs derived from a keyed hash (HMAC-SHA256) of the
+    original, so that a UID is replaced by the same UID in every file and
+    every run with the same key, and references between files stay intact.
+    New UIDs are made from the first 128 bits of the hash under the 2.25
+    root (PS3.5 B.2). Standard UIDs, such as SOP classes and transfer
+    syntaxes, are kept. Mappings are cached, since many files share a study
+    and series, and can be stored in the index, in which case a stored
+    mapping is used even if the key has changed."""
+
+    def __init__(self, key, index=None, db_lock=None, cache_size=UID_CACHE_SIZE):
+        self.key = key
+        self.index = index
+        self.db_lock = db_lock
+        self.remap = lru_cache(maxsize=cache_size)(self.lookup)
+
+    def hash(self, uid):
+        digest = hmac.new(self.key, uid.encode('ascii'), hashlib.sha256).digest()
+        return UID_ROOT + str(int.from_bytes(digest[:16], 'big'))
+
+    def lookup(self, uid):
+        if not UID(uid).is_private:
+            return uid
+        if self.index is None:
+            return self.hash(uid)
+
+        try:
+            self.db_lock.acquire()
+            pseudonym = self.index.get_uid(uid)
+            if pseudonym is None:
+                pseudonym = self.hash(uid)
+                self.index.insert_uid(uid, pseudonym)
+        finally:
+            self.db_lock.release()
+        return pseudonym
+
+    def remap_element(self, e):
+        if not e.value:
+            return
+        if e.VM > 1:
+            e.value = [self.remap(str(uid)) for uid in e.value]
+        else:
+            e.value = self.remap(str(e.value))
+
+
+class PixelScreen(object):
+    """Screens pixel data for burnt-in text. Frames are downsampled to at most
+    SCREEN_SIZE pixels a side by taking the brightest pixel of every block,
+    so that thin strokes survive, and are split into bright and dark pixels
+    at SCREEN_THRESHOLD of the range of each frame, since text is burnt in at
+    (nearly) the brightest value. Text has many changes between bright and
+    dark pixels both along rows and along columns, on a mostly dark
+    background, where edges of anatomy and noise do not. An image is
+    suspicious if enough tiles along the borders of a frame, where
+    annotations are placed, look like text. Frames are screened
+    SCREEN_BATCH_FRAMES at a time with array operations."""
+
+    def __init__(self, size=SCREEN_SIZE, threshold=SCREEN_THRESHOLD, density=SCREEN_DENSITY,
+                 min_tiles=SCREEN_MIN_TILES):
+        if numpy is None:
+            raise Exception('Pixel screening requires NumPy.')
+        self.size = size
+        self.threshold = threshold
+        self.density = density
+        self.min_tiles = min_tiles
+
+    @staticmethod
+    def combine_samples(arr, ds):
+        # Keeps the luminance or the brightest sample of color images, samples are the last axis
+        if str(ds.get('PhotometricInterpretation', '')).startswith('YBR'):
+            return arr[..., 0]
+        return arr.max(axis=-1)
+
+    @staticmethod
+    def frames(ds):
+        # Pixel data as (frames, rows, columns)
+        arr = ds.pixel_array
+        if ds.get('SamplesPerPixel', 1) > 1:
+            arr = PixelScreen.combine_samples(arr, ds)
+        if arr.ndim == 2:
+            arr = arr[numpy.newaxis]
+        return arr
+
+    @staticmethod
+    def batches(frames):
+        for start in range(0, frames.shape[0], SCREEN_BATCH_FRAMES):
+            yield frames[start:start + SCREEN_BATCH_FRAMES]
+
+    @staticmethod
+    def streamed_batches(ds, source_path, pixel_data_extent):
+        # Native pixel data is mapped from the file, so that only one batch of frames is in memory at a time
+        transfer_syntax = ds.file_meta.get('TransferSyntaxUID', None)
+        if transfer_syntax is not None and UID(transfer_syntax).is_compressed:
+            raise ValueError('compressed pixel data is not screened when streamed')
+        bits = ds.get('BitsAllocated', 0)
+        photometric = str(ds.get('PhotometricInterpretation', ''))
+        if bits not in (8, 16, 32) or photometric.endswith(('_422', '_420')):
+            raise ValueError('pixel data with %d bits allocated and %s is not screened when streamed' %
+                             (bits, photometric))
+
+        dtype = numpy.dtype('<%s%d' % ('i' if ds.get('PixelRepresentation', 0) else 'u', bits // 8))
+        samples = ds.get('SamplesPerPixel', 1)
+        shape = (int(ds.get('NumberOfFrames', 1) or 1), ds.Rows, ds.Columns)
+        if samples > 1:
+            shape = shape[:1] + (samples,) + shape[1:] if ds.get('PlanarConfiguration', 0) else shape + (samples,)
+        start, end = pixel_data_extent
+        offset = start + (ITEM_HEADER.size if ds.is_implicit_VR else PIXEL_DATA_HEADER.size)
+        if offset + dtype.itemsize * int(numpy.prod(shape)) > end:
+            raise ValueError('pixel data is shorter than its header describes')
+
+        frames = numpy.memmap(source_path, dtype=dtype, mode='r', offset=offset, shape=shape)
+        try:
+            for batch in PixelScreen.batches(frames):
+                if samples > 1:
+                    if ds.get('PlanarConfiguration', 0):
+                        batch = numpy.moveaxis(batch, 1, -1)
+                    batch = PixelScreen.combine_samples(batch, ds)
+                yield numpy.array(batch)
+        finally:
+            del frames
+
+    def downsample(self, frames, inverted):
+        _, rows, cols = frames.shape
+        step = -(-max(rows, cols) // self.size)
+        if step == 1:
+            return frames
+        # Strided element-wise reductions, much faster than reducing a reshaped array
+        reduce = numpy.minimum if inverted else numpy.maximum
+        frames = frames[:, :rows // step * step, :cols // step * step]
+        pooled = frames[:, ::step]
+        for i in range(1, step):
+            pooled = reduce(pooled, frames[:, i::step])
+        result = pooled[:, :, ::step]
+        for i in range(1, step):
+            result = reduce(result, pooled[:, :, i::step])
+        return result
+
+    def text_tiles(self, frames, inverted):
+        lo = frames.min(axis=(1, 2), keepdims=True).astype(numpy.float64)
+        hi = frames.max(axis=(1, 2), keepdims=True).astype(numpy.float64)
+        if inverted:
+            bright = frames <= hi - (hi - lo) * self.threshold
+            dark = frames >= hi - (hi - lo) * SCREEN_DARK
+        else:
+            bright = frames >= lo + (hi - lo) * self.threshold
+            dark = frames <= lo + (hi - lo) * SCREEN_DARK
+
+        n, rows, cols = bright.shape
+        tile_rows, tile_cols = (rows - 1) // SCREEN_TILE, (cols - 1) // SCREEN_TILE
+        if tile_rows == 0 or tile_cols == 0:
+            return None
+        height, width = tile_rows * SCREEN_TILE, tile_cols * SCREEN_TILE
+
+        shape = (n, tile_rows, SCREEN_TILE, tile_cols, SCREEN_TILE)
+        across = (bright[:, :height, 1:width + 1] != bright[:, :height, :width]).reshape(shape).mean(axis=(2, 4))
+        down = (bright[:, 1:height + 1, :width] != bright[:, :height, :width]).reshape(shape).mean(axis=(2, 4))
+        background = dark[:, :height, :width].reshape(shape).mean(axis=(2, 4))
+        # Strokes in both directions, as opposed to straight lines
+        strokes = (across + down >= self.density) & (numpy.minimum(across, down) >= self.density / 4)
+        return strokes & (background >= SCREEN_BACKGROUND)
+
+    @staticmethod
+    def border(tile_rows, tile_cols):
+        band_rows = max(1, int(round(tile_rows * SCREEN_BORDER)))
+        band_cols = max(1, int(round(tile_cols * SCREEN_BORDER)))
+        mask = numpy.zeros((tile_rows, tile_cols), dtype=bool)
+        mask[:band_rows] = mask[-band_rows:] = True
+        mask[:, :band_cols] = mask[:, -band_cols:] = True
+        return mask
+
+    def screen(self, ds, source_path=None, pixel_data_extent=None):
+        # Streamed files have no Pixel Data in ds, it is read from its extent in source_path
+        if pixel_data_extent is None and PIXEL_DATA not in ds:
+            return False, ''
+
+        inverted = ds.get('PhotometricInterpretation', '') == 'MONOCHROME1'
+        try:
+            if pixel_data_extent is not None:
+                batches = self.streamed_batches(ds, source_path, pixel_data_extent)
+            else:
+                batches = self.batches(self.frames(ds))
+            for batch in batches:
+                tiles = self.text_tiles(self.downsample(batch, inverted), inverted)
+                if tiles is None:
+                    return False, ''
+                tiles &= self.border(tiles.shape[1], tiles.shape[2])
+                if (tiles.sum(axis=(1, 2)) >= self.min_tiles).any():
+                    return True, 'Suspected burnt-in text'
+        except Exception as err:
+            logger.warning('Could not screen pixel data of %s: %s' % (source_path or ds.get('SOPInstanceUID', 'dataset'), err))
+        return False, ''
+
+
+class PixelMasks(object):
+    """Rectangular regions of pixel data that are blanked, such as where a
+    device burns in patient details. Regions are configured per
+    (Manufacturer, ManufacturerModelName, Rows, Columns), as the left, top,
+    width and height in pixels, and are blanked in all frames at once. Native
+    (uncompressed) pixel data is changed in place. Compressed pixel data is
+    decoded, and written as Explicit VR Little Endian after masking, since it
+    cannot be compressed again."""
+
+    def __init__(self, regions):
+        if numpy is None:
+            raise Exception('Pixel masking requires NumPy.')
+        self.regions = {}
+        for manufacturer, model, rows, columns, left, top, width, height in regions:
+            key = (manufacturer.strip().lower(), model.strip().lower(), int(rows), int(columns))
+            self.regions.setdefault(key, []).append(
+                (int(top), int(top) + int(height), int(left), int(left) + int(width)))
+
+    @staticmethod
+    def load(fn, skip_first_line=False):
+        with open(fn, 'r') as f:
+            if skip_first_line is True:
+                next(f, None)
+            reader = csv.reader(f)
+            return [row for row in reader if row]
+
+    def regions_for(self, ds):
+        key = (str(ds.get('Manufacturer', '')).strip().lower(), str(ds.get('ManufacturerModelName', '')).strip().lower(),
+               ds.get('Rows', None), ds.get('Columns', None))
+        return self.regions.get(key, None)
+
+    @staticmethod
+    def fill_value(ds):
+        # Black, per sample for color images
+        bits = ds.BitsStored
+        if ds.get('PixelRepresentation', 0) == 1:
+            lo, hi = -(1 << (bits - 1)), (1 << (bits - 1)) - 1
+        else:
+            lo, hi = 0, (1 << bits) - 1
+        photometric = ds.get('PhotometricInterpretation', '')
+        if photometric == 'MONOCHROME1':
+            return hi
+        if photometric.startswith('YBR'):
+            return [lo, 1 << (bits - 1), 1 << (bits - 1)]
+        return lo
+
+    @staticmethod
+    def native_array(ds, buffer):
+        # A writable view of native pixel data as (frames, rows, columns, samples)
+        bits = ds.BitsAllocated
+        if bits not in (8, 16, 32) or ds.get('PhotometricInterpretation', '') == 'YBR_FULL_422':
+            raise ValueError('Cannot mask pixel data with %d bits allocated in %s' %
+                             (bits, ds.get('PhotometricInterpretation', '')))
+        dtype = numpy.dtype('%s%s%d' % ('<' if ds.is_little_endian else '>',
+                                        'i' if ds.get('PixelRepresentation', 0) == 1 else 'u', bits // 8))
+        frames = int(ds.get('NumberOfFrames', 1) or 1)
+        rows, columns, samples = ds.Rows, ds.Columns, ds.get('SamplesPerPixel', 1)
+        arr = numpy.frombuffer(buffer, dtype, frames * rows * columns * samples)
+        if samples > 1 and ds.get('PlanarConfiguration', 0) == 1:
+            return arr.reshape(frames, samples, rows, columns).transpose(0, 2, 3, 1)
+        return arr.reshape(frames, rows, columns, samples)
+
+    @staticmethod
+    def decoded_array(ds):
+        try:
+            arr = ds.pixel_array
+        except Exception as err:  # No handler for the transfer syntax or invalid pixel data
+            raise ValueError('Could not decode pixel data to mask it: %s' % err)
+        arr = numpy.array(arr, order='C')
+
+        # Decoded pixel data is native, interleaved and, for color images, RGB
+        ds.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+        ds.is_little_endian = True
+        ds.is_implicit_VR = False
+        if ds.get('SamplesPerPixel', 1) > 1:
+            ds.PlanarConfiguration = 0
+            if ds.get('PhotometricInterpretation', '') in ('YBR_FULL_422', 'YBR_ICT', 'YBR_RCT'):
+                ds.PhotometricInterpretation = 'RGB'
+        return arr
+
+    def mask(self, ds):
+        regions = self.regions_for(ds)
+        if not regions or PIXEL_DATA not in ds:
+            return False
+
+        transfer_syntax = ds.file_meta.get('TransferSyntaxUID', None)
+        if transfer_syntax is not None and transfer_syntax.is_compressed:
+            decoded = self.decoded_array(ds)
+            arr = decoded.reshape(int(ds.get('NumberOfFrames', 1) or 1), ds.Rows, ds.Columns,
+                                  ds.get('SamplesPerPixel', 1))
+        else:
+            buffer = bytearray(ds.PixelData)
+            arr = self.native_array(ds, buffer)
+
+        fill = self.fill_value(ds)
+        for top, bottom, left, right in regions:
+            arr[:, top:bottom, left:right] = fill
+
+        if transfer_syntax is not None and transfer_syntax.is_compressed:
+            ds.PixelData = decoded.astype(decoded.dtype.newbyteorder('<'), copy=False).tobytes()
+            ds[PIXEL_DATA].is_undefined_length = False
+            ds[PIXEL_DATA].VR = 'OB' if ds.BitsAllocated <= 8 else 'OW'
+        else:
+            ds.PixelData = bytes(buffer)
+        return True
+
+
+class FileListing(object):
+    """Files below a directory with their size and modification time. Listings
+    are made by crawling subdirectories concurrently with os.scandir, which
+    on most platforms knows whether an entry is a directory without a stat
+    call, so every file is stat'ed once. A listing can be saved to a CSV file
+    and loaded again by a later step of the same job. The file can hold the
+    listings of several directories. The modification time of every
+    directory is saved with it, and a listing whose directories have changed
+    since is not loaded."""
+
+    def __init__(self, root, entries, directories=()):
+        # Entries are (directory, filename, size, mtime), sorted by path, directories are (directory, mtime)
+        self.root = root
+        self.entries = entries
+        self.directories = directories
+
+    @staticmethod
+    def crawl_worker(queue, entries, directories, errors):
+        while True:
+            directory = queue.get()
+            if directory is None:
+                break
+
+            try:
+                # Taken before listing, so that files added while listing show up as a change
+                directories.append((directory, os.stat(directory).st_mtime))
+                with os.scandir(directory) as it:
+                    for entry in it:
+                        try:
+                            # Like os.walk, symbolic links to directories are not followed, and are not files either
+                            if entry.is_dir():
+                                if not entry.is_symlink():
+                                    queue.put(entry.path)
+                                continue
+                            st = entry.stat()
+                        except OSError:
+                            continue
+                        entries.append((directory, entry.name, st.st_size, st.st_mtime))
+            except OSError as err:
+                errors.append(err)
+            finally:
+                queue.task_done()
+
+    @staticmethod
+    def crawl(root, num_workers=CRAWL_WORKERS):
+        queue = Queue()
+        queue.put(root)
+        results = []
+        directories = []
+        errors = []
+
+        threads = []
+        for _ in range(num_workers):
+            entries = []
+            results.append(entries)
+            t = Thread(target=FileListing.crawl_worker, args=(queue, entries, directories, errors,))
+            threads.append(t)
+            t.daemon = True
+            t.start()
+
+        queue.join()
+
+        for _ in range(num_workers):
+            queue.put(None)
+        for t in threads:
+            t.join()
+
+        for err in errors:
+            logger.error('Error listing directory %s: %s' % (err.filename, err.strerror))
+
+        return FileListing(root, sorted(entry for entries in results for entry in entries), sorted(directories))
+
+    @staticmethod
+    def load(filename, root):
+        # Returns None if there is no listing of root, or if it is out of date
+        if not os.path.isfile(filename):
+            return None
+        entries = []
+        directories = []
+        with open(filename, 'r', newline='') as f:
+            reader = csv.reader(f)
+            next(reader, None)
+            for listing_root, directory, name, size, mtime in reader:
+                if listing_root != root:
+                    continue
+                directory = os.path.join(root, directory) if directory else root
+                if name:
+                    entries.append((directory, name, int(size), float(mtime)))
+                else:
+                    directories.append((directory, float(mtime)))
+        if not directories:
+            return None
+
+        # Files are added, removed or renamed in a directory by changing it
+        for directory, mtime in directories:
+            try:
+                current = os.stat(directory).st_mtime
+            except OSError:
+                current = None
+            if current != mtime:
+                logger.info('Listing of %s in %s is out of date, listing it again' % (root, filename))
+                return None
+        return FileListing(root, entries, directories)
+
+    def save(self, filename):
+        # Listings of other directories in the same file are kept
+        rows = []
+        if os.path.isfile(filename):
+            with open(filename, 'r', newline='') as f:
+                reader = csv.reader(f)
+                next(reader, None)
+                rows = [row for row in reader if row[0] != self.root]
+        with open(filename, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(LISTING_FIELDS)
+            writer.writerows(rows)
+            writer.writerows((self.root, self.relpath(directory), name, size, repr(mtime))
+                             for directory, name, size, mtime in self.entries)
+            # Rows without a filename hold the modification time of a directory
+            writer.writerows((self.root, self.relpath(directory), '', '', repr(mtime))
+                             for directory, mtime in self.directories)
+
+    def relpath(self, directory):
+        return os.path.relpath(directory, self.root) if directory != self.root else ''
+
+    def __len__(self):
+        return len(self.entries)
+
+    def tasks(self):
+        return [(directory, name,) for directory, name, _, _ in self.entries]
+
+    def sizes(self):
+        return [size for _, _, size, _ in self.entries]
+
+    def paths(self):
+        return [os.path.join(directory, name) for directory, name, _, _ in self.entries]
+
+
+class PollingWatcher(object):
+
+    def __init__(self, root, poll_interval):
+        self.root = root
+        self.poll_interval = poll_interval
+
+    def close(self):
+        pass
+
+    def changes(self):
+        # None tells the caller to rescan the whole directory
+        time.sleep(self.poll_interval)
+        return None
+
+
+class InotifyWatcher(object):
+
+    def __init__(self, root, poll_interval):
+        self.root = root
+        self.poll_interval = poll_interval
+        self.watches = {}
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'Could not initialize inotify')
+        for directory, _, _ in os.walk(root):
+            self.add_watch(directory)
+
+    @staticmethod
+    def available():
+        return platform.startswith('linux') and ctypes.util.find_library('c') is not None
+
+    def add_watch(self, directory):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(directory), INOTIFY_MASK)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), 'Could not watch directory %s' % directory)
+        self.watches[wd] = directory
+
+    def close(self):
+        os.close(self.fd)
+
+    def read_events(self):
+        data = b''
+        while True:
+            try:
+                chunk = os.read(self.fd, 65536)
+            except BlockingIOError:
+                return data
+            if not chunk:
+                return data
+            data += chunk
+
+    def changes(self):
+        paths = set()
+        readable, _, _ = select.select([self.fd], [], [], self.poll_interval)
+        if not readable:
+            return paths
+
+        data = self.read_events()
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = INOTIFY_EVENT.unpack_from(data, offset)
+            offset += INOTIFY_EVENT.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+
+            if mask & IN_Q_OVERFLOW:
+                # Events were lost, the caller has to rescan
+                return None
+
+            directory = self.watches.get(wd)
+            if directory is None or not name:
+                continue
+
+            path = os.path.join(directory, os.fsdecode(name))
+            if mask & IN_ISDIR:
+                # Files may have been created before the new directory was watched
+                for root, _, files in os.walk(path):
+                    self.add_watch(root)
+                    paths.update(os.path.join(root, filename) for filename in files)
+            else:
+                paths.add(path)
+        return paths
+
+
+class JobHandler(socketserver.StreamRequestHandler):
+    """Handles one job per connection. A job is a single line of JSON with
+    the keys files (optional list of paths in ident_dir), ident_dir and
+    clean_dir (both optional, default to the directories the server was
+    started with) and skip_prior (optional, defaults to true). The counts are
+    sent back as a single line of JSON."""
+
+    def handle(self):
+        try:
+            job = json.loads(self.rfile.readline().decode('utf-8'))
+            result = self.server.pseudon.run_job(job)
+        except Exception as err:
+            logger.error('Job failed: %s' % err)
+            result = {'error': str(err)}
+        self.wfile.write((json.dumps(result) + '\n').encode('utf-8'))
+
+
+class DicomPseudon(object):
+    def __init__(self, white_list_file, **kwargs):
+        self.white_list_file = white_list_file
+        self.index_file = kwargs.get('index_file', 'index.db')
+        self.quarantine = kwargs.get('quarantine', 'quarantine')
+        self.log_file = kwargs.get('log_file', 'dicom_pseudon.log')
+        self.modalities = [string.lower() for string in kwargs.get('modalities', ['mr', 'ct'])]
+        self.large_file_size = kwargs.get('large_file_size', LARGE_FILE_SIZE) * 1024 * 1024
+        self.deflate = kwargs.get('deflate', False)
+        self.deflate_level = kwargs.get('deflate_level', DEFLATE_LEVEL)
+        self.max_workers = kwargs.get('max_workers', None)
+        self.listing_file = kwargs.get('listing', None)
+        self.crawl_workers = kwargs.get('crawl_workers', CRAWL_WORKERS)
+        skip_first_line = kwargs.get('white_list_skip_first_line', False)
+        is_test = kwargs.get('is_test', False)
+
+        try:
+            content = self.load_white_list(white_list_file, skip_first_line)
+            self.white_list = self.parse_white_list(content)
+        except IOError:
+            raise Exception('Could not open white list file.')
+
+        rules = DEFAULT_QUARANTINE_RULES
+        rules_file = kwargs.get('quarantine_rules', None)
+        if rules_file:
+            try:
+                rules = QuarantineRules.load(rules_file, kwargs.get('quarantine_rules_skip_first_line', False))
+            except IOError:
+                raise Exception('Could not open quarantine rules file.')
+        self.quarantine_rules = QuarantineRules(rules, self.modalities)
+        self.pixel_screen = PixelScreen() if kwargs.get('screen_pixels', False) else None
+
+        self.pixel_masks = None
+        masks_file = kwargs.get('pixel_masks', None)
+        if masks_file:
+            try:
+                self.pixel_masks = PixelMasks(PixelMasks.load(masks_file, kwargs.get('pixel_masks_skip_first_line', False)))
+            except IOError:
+                raise Exception('Could not open pixel masks file.')
+
+        self.index = Index(self.index_file)
+
+        manifest_file = kwargs.get('manifest', None)
+        self.manifest = Manifest(manifest_file) if manifest_file else None
+
+        # Owned, so that a timed out worker that still holds one can be detected
+        self.fs_lock = OwnedLock()
+        self.db_lock = OwnedLock()
+
+        self.uid_remapper = None
+        uid_key_file = kwargs.get('uid_key_file', None)
+        if uid_key_file:
+            try:
+                with open(uid_key_file, 'rb') as f:
+                    key = f.read().strip()
+            except IOError:
+                raise Exception('Could not open UID key file.')
+            index = self.index if kwargs.get('uid_table', False) else None
+            self.uid_remapper = UIDRemapper(key, index, self.db_lock)
+
+        self.profiler = None
+        profile = kwargs.get('profile', None)
+        if profile:
+            hotspots = [self.buffer_fingerprint, dcmread, self.clean, Dataset.save_as]
+            hotspots.extend(f for name, f in sorted(vars(Index).items()) if callable(f) and not name.startswith('_'))
+            self.profiler = Profiler(profile, hotspots)
+
+        # Files that take longer than this are quarantined, and their worker is replaced
+        file_timeout = kwargs.get('file_timeout', None)
+        self.watchdog = Watchdog(file_timeout, self.file_timed_out) if file_timeout else None
+
+        # Limits the number of files processed at once by all jobs in server mode
+        self.worker_slots = None
+
+        # Directory listings made during the lifetime of this instance
+        self.listings = {}
+
+        # Links that are not used yet in single pass mode, and the links made while pseudonymizing
+        self.single_pass_links = None
+        self.single_pass_linked = []
+        self.single_pass_seen = set()
+
+        # Links that are not used yet in watch and server mode, and the size and mtime of the links file
+        # they were read from, so that the file is read again when it changes
+        self.links = None
+        self.links_state = None
+
+        # Accession numbers of the files that were quarantined because they were not linked, in watch mode
+        self.unlinked_files = None
+
+        # Guards the fingerprints of files seen in each run, see run_tasks
+        self.in_flight_lock = Lock()
+
+        # Skip logging handlers for tests
+        if is_test:
+            return
+
+        logger.handlers = []
+        if not self.log_file:
+            self.log = logging.StreamHandler()
+        else:
+            self.log = logging.FileHandler(self.log_file)
+
+        self.log.setLevel(logging.INFO)
+        formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+        self.log.setFormatter(formatter)
+        logger.addHandler(self.log)
+
+    def close_all(self):
+        if self.profiler is not None:
+            self.profiler.report()
+        if self.manifest is not None:
+            self.manifest.close()
+            self.manifest = None
+        if self.log_file:
+            self.log.flush()
+            self.log.close()
+        self.index.close()
+
+    def record(self, input_path, status, fingerprint=None, output_path=None, output_hash=None, serial=None,
+               reason='', started=None):
+        if self.manifest is None:
+            return
+        if self.watchdog is not None and self.watchdog.is_abandoned():
+            # The file timed out, and has been recorded as quarantined
+            return
+        seconds = None if started is None else round(time.time() - started, 6)
+        self.manifest.add((input_path, fingerprint, output_path, output_hash, serial, status, reason, seconds))
+
+    def log_summary(self):
+        if self.watchdog is not None and self.watchdog.timeouts > 0:
+            logger.info('%d DICOM files were moved to quarantine directory because processing them took longer '
+                        'than %d seconds' % (self.watchdog.timeouts, self.watchdog.time_limit))
+        if self.manifest is None:
+            return
+        for status, count in sorted(self.manifest.statuses.items()):
+            logger.info('%d DICOM files with status %s' % (count, status))
+        for reason, count in self.manifest.reasons.most_common():
+            logger.info('%d DICOM files were moved to quarantine directory due to: %s' % (count, reason))
+
+    @staticmethod
+    def destination(source, dest, root):
+        if dest.startswith(root):
+            raise Exception('Destination directory cannot be inside or equal to source directory')
+        if not source.startswith(root):
+            raise Exception('The file to be moved must be in the root directory')
+        return os.path.normpath(dest)
+
+    def quarantine_file(self, filepath, ident_dir, reason, fingerprint=None, started=None):
+        if self.watchdog is not None and not self.watchdog.finish():
+            # The file timed out and has been quarantined by the watchdog
+            return
+        full_quarantine_dir = self.destination(filepath, self.quarantine, ident_dir)
+        try:
+            os.makedirs(full_quarantine_dir)
+        except FileExistsError:
+            # Another worker created it first
+            pass
+        quarantine_name = os.path.join(full_quarantine_dir, os.path.basename(filepath))
+        if self.manifest is None:
+            logger.info('%s will be moved to quarantine directory due to: %s' % (filepath, reason))
+        shutil.copyfile(filepath, quarantine_name)
+        self.record(filepath, 'quarantined', fingerprint, quarantine_name, reason=reason, started=started)
+
+    def held_locks(self, thread):
+        return [name for name, lock in (('file system', self.fs_lock), ('index', self.db_lock))
+                if lock.owner == thread.ident]
+
+    def file_timed_out(self, filepath, started, thread, context, output):
+        ident_dir, queue, pbar, counter_queue, counts, pool = context
+        if output is not None and os.path.exists(output):
+            os.remove(output)
+        held = self.held_locks(thread)
+        if held:
+            # Every other worker would wait for the lock forever, only a new process can continue.
+            # Nothing is committed before the output is complete, so the next run picks up from here.
+            logger.error('Worker stuck on %s while holding the %s lock, stopping. Run again to process the '
+                         'remaining files' % (filepath, ' and '.join(held)))
+            if self.log_file:
+                self.log.flush()
+            os._exit(STUCK_EXIT_CODE)
+        if ident_dir is None:
+            # Only the header was read, to index or plan the file. The run quarantines it if it times out again.
+            logger.warning('Reading %s timed out after %d seconds' % (filepath, self.watchdog.time_limit))
+        else:
+            self.quarantine_file(filepath, ident_dir,
+                                 'Processing timed out after %d seconds' % self.watchdog.time_limit, started=started)
+
+        # Finish the task of the stuck worker, and replace it
+        if counter_queue is not None:
+            counter_queue.put(counts)
+        if pool is not None:
+            pool.replace(thread)
+        if self.worker_slots is not None and ident_dir is not None:
+            self.worker_slots.release()
+        queue.task_done()
+        pbar.update()
+
+    def check_quarantine(self, ds):
+        return self.quarantine_rules.evaluate(ds)
+
+    def check_pixels(self, ds, source_path=None, pixel_data_extent=None):
+        if self.pixel_screen is None:
+            return False, ''
+        return self.pixel_screen.screen(ds, source_path, pixel_data_extent)
+
+    def check_quarantine_header(self, filepath):
+        # Only reads the tags referenced by the quarantine rules
+        tags = self.quarantine_rules.tags
+        if self.single_pass_links is not None:
+            # Quarantined files are linked too, like in the index
+            tags = tags + [Tag(ACCESSION_NUMBER)]
+        ds = dcmread(filepath, stop_before_pixels=True, specific_tags=tags)
+        if self.single_pass_links is not None and 'AccessionNumber' in ds:
+            self.link_single_pass(ds.AccessionNumber)
+        return self.check_quarantine(ds)
+
+    @staticmethod
+    def load_white_list(fn, skip_first_line=False):
+        with open(fn, 'r') as f:
+            reader = csv.reader(f)
+            if skip_first_line is True:
+                next(f, None)
+            return [','.join(row) for row in reader]
+
+
+    @staticmethod
+    def parse_white_list(content):
+        values = {}
+        for tag in content:
+            a, b = re.sub(r'[\(\)]', '', tag).split(',')
+            t = (int(a, 16), int(b, 16))
+            values[t] = 1
+        return values
+
+    @staticmethod
+    def buffer_fingerprint(filepath, buffer):
+        hash = hashlib.md5()
+        with open(filepath, 'rb') as f:
+            for chunk in iter(lambda: f.read(65536), b''):
+                hash.update(chunk)
+                buffer.write(chunk)
+        return hash.hexdigest()
+
+    @staticmethod
+    def file_fingerprint(filepath):
+        hash = hashlib.md5()
+        with open(filepath, 'rb') as f:
+            for chunk in iter(lambda: f.read(65536), b''):
+                hash.update(chunk)
+        return hash.hexdigest()
+
+    @staticmethod
+    def stop_at_pixel_data(tag, VR, length):
+        return tag == PIXEL_DATA_TAG
+
+    @staticmethod
+    def pixel_data_extent(f, is_implicit_VR):
+        # Finds the end of the Pixel Data element that starts at the current
+        # position of f, by skipping over its value (and items, if encapsulated)
+        start = f.tell()
+        if is_implicit_VR:
+            group, element, length = ITEM_HEADER.unpack(f.read(ITEM_HEADER.size))
+        else:
+            group, element, vr = struct.unpack('<HH2s', f.read(6))
+            if vr in EXTRA_LENGTH_VRS:
+                length, = struct.unpack('<2xL', f.read(6))
+            else:
+                length, = struct.unpack('<H', f.read(2))
+
+        if length != UNDEFINED_LENGTH:
+            return start, f.tell() + length
+
+        while True:
+            header = f.read(ITEM_HEADER.size)
+            if len(header) < ITEM_HEADER.size:
+                return None
+            group, element, length = ITEM_HEADER.unpack(header)
+            if (group, element) == SEQUENCE_DELIMITER:
+                return start, f.tell()
+            f.seek(length, io.SEEK_CUR)
+
+    def read_header(self, filepath):
+        """Reads a file up to its Pixel Data. Returns the dataset and the extent
+        of the Pixel Data element in the file, so that it can be copied to the
+        output without loading it. If the Pixel Data cannot be copied as is, the
+        whole file is read and the extent is None."""
+        with open(filepath, 'rb') as f:
+            ds = read_partial(f, stop_when=self.stop_at_pixel_data)
+            file_size = os.fstat(f.fileno()).st_size
+            if f.tell() == file_size:
+                # There is no Pixel Data
+                return ds, None
+
+            transfer_syntax = ds.file_meta.get('TransferSyntaxUID', None)
+            extent = None
+            if ds.is_little_endian and transfer_syntax != DeflatedExplicitVRLittleEndian:
+                extent = self.pixel_data_extent(f, ds.is_implicit_VR)
+
+        # Elements after the Pixel Data would not be cleaned if copied as is
+        if extent is None or extent[1] != file_size:
+            return dcmread(filepath), None
+        return ds, extent
+
+    @staticmethod
+    def read_chunks(filepath, start, end):
+        with open(filepath, 'rb') as f:
+            f.seek(start)
+            remaining = end - start
+            while remaining > 0:
+                chunk = f.read(min(COPY_CHUNK_SIZE, remaining))
+                if not chunk:
+                    raise IOError('Unexpected end of file %s' % filepath)
+                remaining -= len(chunk)
+                yield chunk
+
+    def save_dataset(self, ds, filename, source_path=None, pixel_data_extent=None):
+        # Returns the MD5 hash of the written file, if a manifest is written
+        with open(filename, 'wb') as f:
+            out = f if self.manifest is None else HashingWriter(f)
+
+            transfer_syntax = ds.file_meta.get('TransferSyntaxUID', None)
+            if self.deflate and transfer_syntax in DEFLATABLE_SYNTAXES:
+                self.save_deflated_dataset(ds, out, source_path, pixel_data_extent)
+            else:
+                if out is f:
+                    ds.save_as(f)
+                else:
+                    # save_as may seek, so the hash is computed over a buffer
+                    buffer = io.BytesIO()
+                    ds.save_as(buffer)
+                    out.write(buffer.getvalue())
+                    buffer.close()
+
+                # Copy the Pixel Data element from the source, if it was not read
+                if pixel_data_extent is not None:
+                    for chunk in self.read_chunks(source_path, *pixel_data_extent):
+                        out.write(chunk)
+
+            if out is not f:
+                return out.hexdigest()
+
+    def save_deflated_dataset(self, ds, out, source_path=None, pixel_data_extent=None):
+        # Deflated Explicit VR Little Endian, see PS3.5 A.5
+        was_implicit_VR = ds.is_implicit_VR
+        ds.file_meta.TransferSyntaxUID = DeflatedExplicitVRLittleEndian
+        ds.is_implicit_VR = False
+        ds.is_little_endian = True
+
+        meta = DicomBytesIO()
+        write_file_meta_info(meta, ds.file_meta, enforce_standard=False)
+
+        body = DicomBytesIO()
+        body.is_implicit_VR = False
+        body.is_little_endian = True
+        write_dataset(body, ds)
+
+        compressor = zlib.compressobj(self.deflate_level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        out.write(getattr(ds, 'preamble', None) or b'\x00' * DICOM_PREAMBLE_LENGTH)
+        out.write(DICOM_PREFIX)
+        out.write(meta.getvalue())
+        out.write(compressor.compress(body.getvalue()))
+
+        if pixel_data_extent is not None:
+            start, end = pixel_data_extent
+            if was_implicit_VR:
+                # Native Pixel Data has a defined length, only its header needs to be made explicit
+                header_size = ITEM_HEADER.size
+                vr = b'OW' if ds.get('BitsAllocated', 16) > 8 else b'OB'
+                out.write(compressor.compress(PIXEL_DATA_HEADER.pack(
+                    PIXEL_DATA[0], PIXEL_DATA[1], vr, end - start - header_size)))
+                start += header_size
+            for chunk in self.read_chunks(source_path, start, end):
+                out.write(compressor.compress(chunk))
+
+        out.write(compressor.flush())
+
+    @staticmethod
+    def is_dicom_file(filepath):
+        with open(filepath, 'rb') as f:
+            header = f.read(DICOM_PREAMBLE_LENGTH + len(DICOM_PREFIX))
+        return header[DICOM_PREAMBLE_LENGTH:] == DICOM_PREFIX
+
+    def white_list_handler(self, e):
+        value = self.white_list.get((e.tag.group, e.tag.element), None)
+        if value:
+            return True
+        return False
+
+    def list_files(self, root):
+        # A directory is crawled once per instance, or not at all if it is in the listing file
+        listing = self.listings.get(root)
+        if listing is None and self.listing_file:
+            listing = FileListing.load(self.listing_file, root)
+        if listing is None:
+            listing = FileListing.crawl(root, self.crawl_workers)
+            if self.listing_file:
+                listing.save(self.listing_file)
+        self.listings[root] = listing
+        return listing
+
+    def index_built(self):
+        return os.path.exists(INDEXED_LOCK_FNAME)
+
+    def input_yes_or_no_prompt(self, question):
+        while True:
+            answer = input('%s [y/n] ' % question)
+            if answer == 'y':
+                return True
+            elif answer == 'n':
+                return False
+            else:
+                print("I didn't get that. Please enter 'y' (yes) or 'n' (no).")
+
+    def prompt_skip_build_index(self):
+        return self.input_yes_or_no_prompt('Index for search table found. Skip indexing?')
+
+    def prompt_skip_prior(self, dir_name):
+        return self.input_yes_or_no_prompt('Some files in %s have been pseudonymized before. Skip already pseudonymized files?' % dir_name)
+
+    def fingerprints_exist(self):
+        return self.index.table_exists(HASH_TABLE_NAME)
+
+    def register_fingerprint(self, fingerprint, db_lock):
+        try:
+            db_lock.acquire()
+            self.index.insert_hash(fingerprint)
+        finally:
+            db_lock.release()
+
+    def fingerprint_exists(self, fingerprint, db_lock):
+        try:
+            db_lock.acquire()
+            if self.index.get_hash(fingerprint) is not None:
+                return True
+            return False
+        finally:
+            db_lock.release()
+
+    def claim_fingerprint(self, fingerprint, in_flight):
+        try:
+            self.in_flight_lock.acquire()
+            if fingerprint in in_flight:
+                return False
+            in_flight.add(fingerprint)
+            return True
+        finally:
+            self.in_flight_lock.release()
+
+    def clean(self, ds, e):
+        cleaned = None
+        white_listed = self.white_list_handler(e)
+
+        if not white_listed:
+            t = (e.tag.group, e.tag.element)
+            if REQUIRED_TAGS.get(t, None):
+                cleaned = ''
+            elif PIXEL_MODULE_TAGS.get(t, None):
+                return True
+            else:
+                del ds[e.tag]
+                cleaned = REMOVED_TEXT
+
+        if self.uid_remapper is not None and e.VR == 'UI' and e.tag in ds:
+            # Kept UIDs, and required UIDs that would be blanked, are replaced consistently
+            self.uid_remapper.remap_element(ds[e.tag])
+        elif cleaned is not None and e.tag in ds and ds[e.tag].value is not None:
+            ds[e.tag].value = cleaned
+
+        # Tell our caller if we left this element intact
+        return white_listed
+
+    def clean_meta(self, ds, e):
+        white_listed = self.white_list_handler(e)
+
+        if ALLOWED_FILE_META.get((e.tag.group, e.tag.element), None):
+            return False
+        if not white_listed:
+            del ds[e.tag]
+        return white_listed
+
+    def pseudonymize(self, ds, db_lock, source_path=None, pixel_data_extent=None):
+        # Returns the reason to quarantine the file instead if its pixel data is suspicious
+        accession_num = ds.AccessionNumber
+        try:
+            db_lock.acquire()
+            serial_num = self.index.get(accession_num)
+        finally:
+            db_lock.release()
+
+        if serial_num is None:
+            raise ValueError('No serial number for accession number %s' % (accession_num,))
+
+        if self.pixel_masks is not None:
+            self.pixel_masks.mask(ds)
+
+        # Screened after masking, so that masked text is not found, and before the header is cleaned,
+        # which removes attributes that describe the pixel data, such as Number of Frames
+        move, reason = self.check_pixels(ds, source_path, pixel_data_extent)
+        if move:
+            return ds, serial_num, reason
+
+        # Fix file meta data portion
+        if MEDIA_STORAGE_SOP_INSTANCE_UID in ds.file_meta:
+            ds.file_meta[MEDIA_STORAGE_SOP_INSTANCE_UID].value = ds.SOPInstanceUID
+            if self.uid_remapper is not None:
+                self.uid_remapper.remap_element(ds.file_meta[MEDIA_STORAGE_SOP_INSTANCE_UID])
+
+        ds.file_meta.walk(self.clean_meta)
+        ds.walk(partial(self.clean))
+
+        return ds, serial_num, None
+
+    @staticmethod
+    def mark_pseudonymized(ds, serial_num):
+        # Set Accession Number to serial number from links file
+        ds[ACCESSION_NUMBER].value = serial_num
+
+        # Set Patient Identity Removed to YES
+        t = Tag((0x12, 0x62))
+        ds[t] = DataElement(t, 'CS', 'YES')
+
+        # Set the De-identification method
+        t = Tag((0x12, 0x63))
+        ds[t] = DataElement(t, 'LO', DE_IDENTIFICATION_METHOD)
+
+    def pseudonymize_dataset(self, ds):
+        """Pseudonymize a dataset in memory. The dataset is cleaned in place,
+        and a PseudonymizeResult with the cleaned file as bytes is returned."""
+        move, reason = self.check_quarantine(ds)
+        if move:
+            return PseudonymizeResult(None, True, reason, None)
+
+        try:
+            ds, serial_num, reason = self.pseudonymize(ds, self.db_lock)
+        except ValueError as e:
+            return PseudonymizeResult(None, True, str(e), None)
+        if reason:
+            return PseudonymizeResult(None, True, reason, None)
+
+        self.mark_pseudonymized(ds, serial_num)
 
-        with open(links_file, 'r') as f:
-            if skip_first_line is True:
-                next(f, None)
-            reader = csv.reader(f, delimiter=delimiter)
-            logger.info('Indexing variables from links file')
+        buffer = io.BytesIO()
+        try:
+            ds.save_as(buffer)
+            return PseudonymizeResult(buffer.getvalue(), False, '', serial_num)
+        finally:
+            buffer.close()
 
-            with tqdm(total=line_count) as pbar:
-                pbar.set_description('Indexing links file')
-                for line in reader:
-                    try:
-                        invitation_num, serial_num = line
+    def pseudonymize_bytes(self, data):
+        """Pseudonymize a DICOM file given as bytes, see pseudonymize_dataset."""
+        try:
+            ds = dcmread(io.BytesIO(data))
+        except InvalidDicomError:  # DICOM formatting error
+            return PseudonymizeResult(None, True, 'Could not read DICOM file.', None)
+        return self.pseudonymize_dataset(ds)
+
+    def pseudonymize_batch(self, items):
+        """Pseudonymize an iterable of datasets and/or DICOM files as bytes.
+        Yields a PseudonymizeResult for each item, in the same order."""
+        for item in items:
+            if isinstance(item, Dataset):
+                yield self.pseudonymize_dataset(item)
+            else:
+                yield self.pseudonymize_bytes(item)
 
-                        if invitation_num in invitation_num_set:
-                            logger.warning('Invitation number %s appears in links file multiple times' % invitation_num)
-                            continue
+    def build_index_worker(self, ident_dir, queue, pbar, db_lock, accession_numbers=None, indexed=None, pool=None):
+        while True:
+            if pool is not None and pool.should_retire():
+                break
+            task = queue.get()
+            if task is None:
+                break
+
+            root, filename = task
+            if self.watchdog is not None:
+                self.watchdog.begin(os.path.join(root, filename), (None, queue, pbar, None, None, pool))
+            try:
+                if filename.startswith('.'):
+                    continue
+                source_path = os.path.join(root, filename)
+                ds = None
+                try:
+                    ds = dcmread(source_path, stop_before_pixels=True)
+                except IOError:
+                    logger.error('Error reading file %s' % source_path)
+                    continue
+                except InvalidDicomError:  # DICOM formatting error
+                    if indexed is not None:
+                        indexed.append(task)
+                    continue
+                if self.watchdog is not None and self.watchdog.is_abandoned():
+                    continue
+                try:
+                    db_lock.acquire()
+                    self.index.insert(ds.AccessionNumber)
+                finally:
+                    db_lock.release()
+                if accession_numbers is not None:
+                    accession_numbers.append(ds.AccessionNumber)
+                if indexed is not None:
+                    indexed.append(task)
+            finally:
+                if self.watchdog is not None and not self.watchdog.end():
+                    return False
+                queue.task_done()
+                pbar.update()
 
-                        invitation_num_set.add(invitation_num)
-                        accession_num = self.index.search('%' + invitation_num + '%')
+    def start_workers(self, target, args, queue, pbar, num_workers=1):
+        if self.profiler is not None:
+            target = self.profiler.wrap(target)
+        pool = WorkerPool(target, args, queue)
+        pool.start(num_workers)
+        autoscaler = None
+        if self.max_workers and self.max_workers > num_workers:
+            # num_workers is the lower bound, the pool grows while that speeds things up
+            autoscaler = Autoscaler(pool, pbar, num_workers, self.max_workers)
+            autoscaler.start()
+        return pool, autoscaler
 
-                        if accession_num is None:
-                            logger.warning('Could not find accession number for invitation number %s' % invitation_num)
-                            continue
+    @staticmethod
+    def stop_workers(pool, autoscaler):
+        if autoscaler is not None:
+            autoscaler.stop()
+        pool.stop()
+
+    def index_tasks(self, tasks, ident_dir, num_workers=1, accession_numbers=None, indexed=None):
+        queue = Queue()
+        pbar = tqdm(total=len(tasks))
+        pbar.set_description('Indexing acc. numbers')
+
+        for task in tasks:
+            queue.put(task)
+
+        pool, autoscaler = self.start_workers(self.build_index_worker,
+                                              (ident_dir, queue, pbar, self.db_lock, accession_numbers, indexed),
+                                              queue, pbar, num_workers)
+
+        queue.join()
+
+        self.stop_workers(pool, autoscaler)
+
+        pbar.close()
+
+    def build_index(self, ident_dir, links_file, delimiter=',', skip_first_line=False, num_workers=1):
+        logger.info('Indexing accession numbers to search index')
+
+        # Only read files that are new or have changed since the index was last built
+        indexed_files = self.index.indexed_files()
+        listing = self.list_files(ident_dir)
+        file_count = len(listing)
+        tasks = []
+        entries = []
+        for root, filename, size, mtime in listing.entries:
+            path = os.path.abspath(os.path.join(root, filename))
+            if indexed_files.get(path) == (size, mtime):
+                continue
+            tasks.append((root, filename,))
+            entries.append((path, size, mtime))
+
+        # Files that could not be read are read again by the next build
+        accession_numbers = []
+        indexed = []
+        self.index_tasks(tasks, ident_dir, num_workers, accession_numbers, indexed)
+        indexed = set(indexed)
+        self.index.insert_indexed_files([entry for task, entry in zip(tasks, entries) if task in indexed])
+        logger.info('Indexed %d new or changed files, skipped %d unchanged files' % (len(tasks), file_count - len(tasks)))
+
+        logger.info('Indexing variables from links file')
+        links = self.load_links(links_file, delimiter, skip_first_line)
+        known_links = self.index.links()
+
+        # Invitation numbers that are new or have a changed serial number are searched for in the
+        # whole index, unchanged invitation numbers without accession number only in the new files
+        changed = []
+        unlinked = {}
+        for invitation_num, serial_num in links.items():
+            known = known_links.get(invitation_num)
+            if known is None or known[0] != serial_num:
+                changed.append((invitation_num, serial_num))
+            elif known[1] is None:
+                unlinked[invitation_num] = serial_num
+
+        resolved = []
+        with tqdm(total=len(changed)) as pbar:
+            pbar.set_description('Indexing links file')
+            for invitation_num, serial_num in changed:
+                try:
+                    accession_num = self.index.search('%' + invitation_num + '%')
+                    if accession_num is not None:
                         self.index.update(accession_num, serial_num)
-                    finally:
-                        pbar.update()
+                    resolved.append((invitation_num, serial_num, accession_num))
+                finally:
+                    pbar.update()
+
+        resolved.extend(self.link_accession_numbers(accession_numbers, unlinked))
+        self.index.insert_links(resolved)
+
+        # Also invitation numbers that were not found by an earlier build, and are still not linked
+        for invitation_num in sorted([invitation_num for invitation_num, _, accession_num in resolved
+                                      if accession_num is None] + list(unlinked)):
+            logger.warning('Could not find accession number for invitation number %s' % invitation_num)
 
         # Create lock file to indicate that index has been created
         try:
@@ -513,26 +2237,39 @@ class DicomPseudon(object):
             self.close_all()
             return
 
-        logger.info('Indexed %d invitation numbers' % len(invitation_num_set))
+        logger.info('Indexed %d invitation numbers, %d of which were new or changed' % (len(links), len(changed)))
 
+    def walk_dicom(self, ident_dir, clean_dir, ds, source_path, fs_lock, db_lock, fingerprint, pixel_data_extent=None,
+                   started=None):
+        if self.watchdog is not None and self.watchdog.is_abandoned():
+            # The file timed out while it was read, and has been quarantined
+            return False
 
-    def walk_dicom(self, ident_dir, clean_dir, ds, source_path, fs_lock, db_lock, fingerprint):
         move, reason = self.check_quarantine(ds)
 
         if move:
-            self.quarantine_file(source_path, ident_dir, reason)
+            self.quarantine_file(source_path, ident_dir, reason, fingerprint, started)
             return False
 
+        if pixel_data_extent is not None and self.pixel_masks is not None and self.pixel_masks.regions_for(ds):
+            # Pixel data that is masked cannot be streamed
+            ds = dcmread(source_path)
+            pixel_data_extent = None
+
         try:
-            ds, serial_num = self.pseudonymize(ds, db_lock)
+            ds, serial_num, reason = self.pseudonymize(ds, db_lock, source_path, pixel_data_extent)
         except ValueError as e:
             self.quarantine_file(source_path, ident_dir,
                                  'Error running pseudonymize function. ' \
                                  'There may be no serial number for the ' \
                                  'accession number in this DICOM file. ' \
-                                 'Error was: %s' % e)
+                                 'Error was: %s' % e, fingerprint, started)
+            if self.unlinked_files is not None and 'AccessionNumber' in ds:
+                self.unlinked_files[source_path] = ds.AccessionNumber
+            return False
+        if reason:
+            self.quarantine_file(source_path, ident_dir, reason, fingerprint, started)
             return False
-
 
         rel_destination_dir = os.path.join(clean_dir, serial_num)
 
@@ -543,136 +2280,756 @@ class DicomPseudon(object):
             # Do nothing
             pass
 
-        # Set Accession Number to serial number from links file
-        ds[ACCESSION_NUMBER].value = serial_num
+        self.mark_pseudonymized(ds, serial_num)
 
-        # Set Patient Identity Removed to YES
-        t = Tag((0x12, 0x62))
-        ds[t] = DataElement(t, 'CS', 'YES')
+        # Written under a temporary name first, so that a process that crashes while writing leaves no
+        # truncated output. Temporary files start with a dot, so they are never counted or read as input.
+        temp_name = os.path.join(destination_dir, '.%s.tmp' % token_hex(8))
+        if self.watchdog is not None:
+            self.watchdog.claim_output(temp_name)
 
-        # Set the De-identification method
-        t = Tag((0x12, 0x63))
-        ds[t] = DataElement(t, 'LO', DE_IDENTIFICATION_METHOD)
+        try:
+            output_hash = self.save_dataset(ds, temp_name, source_path, pixel_data_extent)
+        except IOError:
+            logger.error('Error writing file %s' % temp_name)
+            if os.path.exists(temp_name):
+                os.remove(temp_name)
+            self.record(source_path, 'error', fingerprint, serial=serial_num, reason='Error writing file',
+                        started=started)
+            return False
+
+        if self.watchdog is not None and not self.watchdog.finish():
+            # The file timed out while it was written, and has been quarantined
+            if os.path.exists(temp_name):
+                os.remove(temp_name)
+            return False
 
         try:
             fs_lock.acquire()
-            count = len([name for name in os.listdir(destination_dir) \
-                         if os.path.isfile(os.path.join(destination_dir, name))])
-            clean_name = os.path.join(destination_dir, "%d.dcm" % (count + 1))
+            count = len([name for name in os.listdir(destination_dir)
+                         if not name.startswith('.') and os.path.isfile(os.path.join(destination_dir, name))])
 
-            try:
-                ds.save_as(clean_name)
-            except IOError:
-                logger.error('Error writing file %s' % clean_name)
-                self.close_all()
-                return False
+            # Linking fails if another process has taken the name, then the next one is tried
+            while True:
+                clean_name = os.path.join(destination_dir, "%d.dcm" % (count + 1))
+                try:
+                    os.link(temp_name, clean_name)
+                    break
+                except FileExistsError:
+                    count += 1
         finally:
             fs_lock.release()
+            os.remove(temp_name)
 
         # Pseudonymization was successful, register fingerprint in database
         self.register_fingerprint(fingerprint, db_lock)
+        self.record(source_path, 'pseudonymized', fingerprint, clean_name, output_hash, serial_num, started=started)
 
         return True
 
-    def run_worker(self, clean_dir, ident_dir, queue, pbar, fs_lock, db_lock, counter_queue, skip_prior):
+    def run_worker(self, clean_dir, ident_dir, queue, pbar, fs_lock, db_lock, counter_queue, skip_prior, in_flight,
+                   pool=None):
         prior = 0
+        duplicates = 0
         pseudonymized = 0
 
         while True:
+            if pool is not None and pool.should_retire():
+                counter_queue.put((pseudonymized, prior, duplicates))
+                break
             task = queue.get()
             if task is None:
-                counter_queue.put((pseudonymized, prior))
+                counter_queue.put((pseudonymized, prior, duplicates))
                 break
 
             root, filename = task
+            if self.worker_slots is not None:
+                self.worker_slots.acquire()
+            if self.watchdog is not None:
+                self.watchdog.begin(os.path.join(root, filename),
+                                    (ident_dir, queue, pbar, counter_queue, (pseudonymized, prior, duplicates), pool))
             try:
                 if filename.startswith('.'):
                     continue
                 source_path = os.path.join(root, filename)
+                started = time.time()
 
+                # Quarantined files are never fingerprinted or fully read
                 try:
-                    buffer = io.BytesIO()
-                    fp = self.buffer_fingerprint(source_path, buffer)
-                    buffer.seek(0)
+                    move, reason = self.check_quarantine_header(source_path)
+                except IOError:
+                    logger.error('Error reading file %s' % source_path)
+                    self.record(source_path, 'error', reason='Error reading file', started=started)
+                    continue
+                except InvalidDicomError:  # DICOM formatting error
+                    move, reason = True, 'Could not read DICOM file.'
+                if move:
+                    self.quarantine_file(source_path, ident_dir, reason, started=started)
+                    continue
+
+                # Large files are hashed and written without keeping them in memory
+                large = os.path.getsize(source_path) >= self.large_file_size
+                buffer = None
+                try:
+                    if large:
+                        fp = self.file_fingerprint(source_path)
+                    else:
+                        buffer = io.BytesIO()
+                        fp = self.buffer_fingerprint(source_path, buffer)
+
+                    # Claimed first, so that a copy of a file that was pseudonymized earlier in
+                    # this run is counted as a duplicate, not as pseudonymized before
+                    if not self.claim_fingerprint(fp, in_flight):
+                        # An identical file has already been seen in this run, skip
+                        duplicates += 1
+                        self.record(source_path, 'duplicate', fp, started=started)
+                        continue
+
+                    if skip_prior and self.fingerprint_exists(fp, db_lock):
+                        # This file has been pseudonymized before, skip
+                        prior += 1
+                        self.record(source_path, 'prior', fp, started=started)
+                        continue
 
                     ds = None
+                    pixel_data_extent = None
                     try:
-                        ds = dcmread(buffer)
+                        if large:
+                            ds, pixel_data_extent = self.read_header(source_path)
+                        else:
+                            buffer.seek(0)
+                            ds = dcmread(buffer)
                     except IOError:
                         logger.error('Error reading file %s' % source_path)
-                        self.close_all()
-                        return False
+                        self.record(source_path, 'error', fp, reason='Error reading file', started=started)
+                        continue
                     except InvalidDicomError:  # DICOM formatting error
-                        self.quarantine_file(source_path, ident_dir, 'Could not read DICOM file.')
+                        self.quarantine_file(source_path, ident_dir, 'Could not read DICOM file.', fp, started)
                         continue
 
-                    if skip_prior and self.fingerprint_exists(fp, db_lock):
-                        # This file has been pseudonymized already, skip
-                        prior += 1
-                    else:
-                        if self.walk_dicom(ident_dir, clean_dir, ds, source_path, fs_lock, db_lock, fp):
-                            pseudonymized += 1
+                    if self.walk_dicom(ident_dir, clean_dir, ds, source_path, fs_lock, db_lock, fp,
+                                       pixel_data_extent, started):
+                        pseudonymized += 1
                 finally:
-                    buffer.close()
+                    if buffer is not None:
+                        buffer.close()
 
+            except Exception as err:
+                # A single file must not stop the worker, or the run would wait for it forever
+                logger.error('Error processing file %s: %s' % (os.path.join(root, filename), err))
+                self.record(os.path.join(root, filename), 'error', reason=str(err))
             finally:
+                if self.watchdog is not None and not self.watchdog.end():
+                    # The file timed out, the watchdog has finished the task and replaced this worker
+                    return False
+                if self.worker_slots is not None:
+                    self.worker_slots.release()
                 queue.task_done()
                 pbar.update()
 
-    def run(self, ident_dir, clean_dir, num_workers=1, skip_prior=False):
-        logger.info('Pseudonymizing DICOM files')
-
-        fs_lock = Lock()
-        db_lock = Lock()
+    def run_tasks(self, tasks, ident_dir, clean_dir, num_workers=1, skip_prior=False):
         counter_queue = Queue()
         queue = Queue()
-        file_count = sum(len(files) for _, _, files in os.walk(ident_dir))
-        pbar = tqdm(total=file_count)
+        pbar = tqdm(total=len(tasks))
         pbar.set_description('Pseudonymizing files')
 
-        for root, _, files in os.walk(ident_dir):
-            for filename in files:
-                queue.put((root, filename,))
+        for task in tasks:
+            queue.put(task)
 
-        threads = []
-        for _ in range(num_workers):
-            t = Thread(target=self.run_worker,
-                       args=(clean_dir, ident_dir, queue, pbar, fs_lock,
-                             db_lock, counter_queue, skip_prior))
-            threads.append(t)
-            t.daemon = True
-            t.start()
+        # Fingerprints of the files seen in this run, identical files are only pseudonymized once
+        in_flight = set()
+        pool, autoscaler = self.start_workers(self.run_worker,
+                                              (clean_dir, ident_dir, queue, pbar, self.fs_lock,
+                                               self.db_lock, counter_queue, skip_prior, in_flight),
+                                              queue, pbar, num_workers)
 
         queue.join()
 
-        for _ in range(num_workers):
-            queue.put(None)
-        for t in threads:
-            t.join()
+        self.stop_workers(pool, autoscaler)
 
         prior = 0
+        duplicates = 0
         pseudonymized = 0
         while True:
             try:
-                pz, pr = counter_queue.get_nowait()
+                pz, pr, du = counter_queue.get_nowait()
                 pseudonymized += pz
                 prior += pr
+                duplicates += du
             except Empty:
                 break
 
         pbar.close()
-        logger.info('Pseudonymized %d of %s DICOM files' % (pseudonymized, file_count))
+        return pseudonymized, prior, duplicates
+
+    @staticmethod
+    def schedule_by_size(tasks, sizes):
+        # Largest files first, so that no worker is left with a large file at the end,
+        # alternated with the smallest files, so that throughput stays up meanwhile
+        order = sorted(range(len(tasks)), key=lambda i: sizes[i], reverse=True)
+        scheduled = []
+        front, back = 0, len(order) - 1
+        while front <= back:
+            scheduled.append(order[front])
+            front += 1
+            if front <= back:
+                scheduled.append(order[back])
+                back -= 1
+        return [tasks[i] for i in scheduled], [sizes[i] for i in scheduled]
+
+    @staticmethod
+    def estimate_makespan(sizes, num_workers):
+        # Every file goes to the first worker that is free, with a cost based on its size
+        workers = [0] * max(num_workers, 1)
+        for size in sizes:
+            heapq.heapreplace(workers, workers[0] + size + PER_FILE_COST)
+        return max(workers)
+
+    def run(self, ident_dir, clean_dir, num_workers=1, skip_prior=False, schedule='walk'):
+        logger.info('Pseudonymizing DICOM files')
+
+        listing = self.list_files(ident_dir)
+        tasks = listing.tasks()
+
+        makespans = None
+        if schedule == 'size':
+            sizes = listing.sizes()
+            walk_makespan = self.estimate_makespan(sizes, num_workers)
+            tasks, sizes = self.schedule_by_size(tasks, sizes)
+            makespans = (walk_makespan, self.estimate_makespan(sizes, num_workers))
+
+        started = time.time()
+        pseudonymized, prior, duplicates = self.run_tasks(tasks, ident_dir, clean_dir, num_workers, skip_prior)
+        logger.info('Pseudonymized %d of %s DICOM files in %.1f seconds' % (pseudonymized, len(tasks), time.time() - started))
+
+        if makespans is not None and makespans[0] > 0:
+            logger.info('Size-aware scheduling reduced the estimated makespan from %.1f MB to %.1f MB per worker (%.1f%%)' %
+                        (makespans[0] / 1048576.0, makespans[1] / 1048576.0,
+                         100.0 * (makespans[0] - makespans[1]) / makespans[0]))
 
         if prior > 0:
-            logger.info('Skipped %d DICOM files because they were either duplicates or pseudonymized before' % prior)
+            logger.info('Skipped %d DICOM files because they were pseudonymized before' % prior)
+
+        if duplicates > 0:
+            logger.info('Skipped %d DICOM files because they were identical to another file in this run' % duplicates)
+
+        if self.single_pass_links is not None:
+            self.finish_single_pass()
+
+        self.log_summary()
+        self.close_all()
+        return True
 
+    def run_single_pass(self, ident_dir, clean_dir, links_file, delimiter=',', skip_first_line=False,
+                        num_workers=1, skip_prior=False, schedule='walk'):
+        """Pseudonymize without building the index first. The links file is
+        loaded up front, and an accession number is linked to an invitation
+        number when the header of the first file with that accession number is
+        read."""
+        logger.info('Linking accession numbers while pseudonymizing')
+        self.single_pass_links = self.unlinked_links(links_file, delimiter, skip_first_line)
+        self.single_pass_linked = []
+        self.single_pass_seen = set()
+        self.links_lock = Lock()
+        return self.run(ident_dir, clean_dir, num_workers, skip_prior, schedule)
+
+    def link_single_pass(self, accession_num):
+        # Every accession number is linked once, by the first worker that reads it
+        if accession_num in self.single_pass_seen:
+            return
+        try:
+            self.links_lock.acquire()
+            # Another worker may have read it while this one waited for the lock
+            if accession_num in self.single_pass_seen:
+                return
+            self.single_pass_seen.add(accession_num)
+            try:
+                self.db_lock.acquire()
+                serial_num = self.index.get(accession_num)
+                if serial_num is None:
+                    self.index.insert(accession_num)
+            finally:
+                self.db_lock.release()
+
+            if serial_num is None:
+                self.single_pass_linked.extend(self.link_accession_numbers([accession_num], self.single_pass_links))
+        finally:
+            self.links_lock.release()
+
+    def finish_single_pass(self):
+        for invitation_num in self.single_pass_links:
+            logger.warning('Could not find accession number for invitation number %s' % invitation_num)
+
+        # Unused invitation numbers are searched for in new files when the index is built later
+        resolved = self.single_pass_linked + [(invitation_num, serial_num, None) for invitation_num, serial_num
+                                              in self.single_pass_links.items()]
+        try:
+            self.db_lock.acquire()
+            self.index.insert_links(resolved)
+        finally:
+            self.db_lock.release()
+        logger.info('Linked %d of %d invitation numbers' % (len(self.single_pass_linked), len(resolved)))
+
+    def renew_leases(self, owner, stopped):
+        while not stopped.wait(LEASE_TIME / 3):
+            try:
+                self.db_lock.acquire()
+                self.index.renew_leases(owner, LEASE_TIME)
+            except sqlite3.Error as err:
+                logger.error('Could not renew leases: %s' % err)
+            finally:
+                self.db_lock.release()
+
+    def cooperate(self, ident_dir, clean_dir, num_workers=1, schedule='walk', job=None):
+        """Pseudonymize the files in ident_dir together with other processes
+        that use the same index. The files are divided into work units, which
+        every process leases from the index one at a time. A lease is renewed
+        while the unit is processed, and a unit whose lease has expired, for
+        example because its process crashed, is leased again by another
+        process. Processes can be added while the job is running: they join
+        the unfinished job with the same id, which defaults to one job per
+        ident_dir and clean_dir, and work on the files it was created with."""
+        logger.info('Pseudonymizing DICOM files together with other processes')
+
+        tasks = self.list_files(ident_dir).tasks()
+        if schedule == 'size':
+            tasks, _ = self.schedule_by_size(tasks, self.list_files(ident_dir).sizes())
+        units = [json.dumps(tasks[i:i + WORK_UNIT_SIZE]) for i in range(0, len(tasks), WORK_UNIT_SIZE)]
+        if job is None:
+            job = hashlib.sha1(json.dumps([os.path.abspath(ident_dir),
+                                           os.path.abspath(clean_dir)]).encode('utf-8')).hexdigest()
+        try:
+            self.db_lock.acquire()
+            self.index.create_work_units(job, units)
+        finally:
+            self.db_lock.release()
+
+        owner = '%s:%d:%s' % (socket.gethostname(), os.getpid(), token_hex(4))
+        stopped = Event()
+        heartbeat = Thread(target=self.renew_leases, args=(owner, stopped,))
+        heartbeat.daemon = True
+        heartbeat.start()
+
+        started = time.time()
+        totals = [0, 0, 0, 0]
+        try:
+            while True:
+                try:
+                    self.db_lock.acquire()
+                    unit = self.index.lease_work_unit(job, owner, LEASE_TIME)
+                    remaining = self.index.remaining_work_units(job)
+                finally:
+                    self.db_lock.release()
+
+                if unit is None:
+                    if remaining == 0:
+                        break
+                    # Other processes are busy with the remaining units, wait for them to finish or expire
+                    time.sleep(min(LEASE_TIME / 10, 10))
+                    continue
+
+                unit_id, unit_tasks = unit
+                unit_tasks = json.loads(unit_tasks)
+                counts = self.run_tasks(unit_tasks, ident_dir, clean_dir, num_workers, skip_prior=True)
+                totals = [total + count for total, count in zip(totals, (len(unit_tasks),) + counts)]
+
+                try:
+                    self.db_lock.acquire()
+                    if not self.index.complete_work_unit(unit_id, owner):
+                        logger.warning('Lease of work unit %d expired before it was completed' % unit_id)
+                finally:
+                    self.db_lock.release()
+        finally:
+            stopped.set()
+            heartbeat.join()
+
+        logger.info('Pseudonymized %d of %d DICOM files in %.1f seconds' % (totals[1], totals[0], time.time() - started))
+        if totals[2] > 0:
+            logger.info('Skipped %d DICOM files because they were pseudonymized before (by any process)' % totals[2])
+        if totals[3] > 0:
+            logger.info('Skipped %d DICOM files because they were identical to another file in this run' % totals[3])
+
+        self.log_summary()
         self.close_all()
         return True
 
+    @staticmethod
+    def load_links(links_file, delimiter=',', skip_first_line=False):
+        links = {}
+        with open(links_file, 'r') as f:
+            if skip_first_line is True:
+                next(f, None)
+            reader = csv.reader(f, delimiter=delimiter)
+            for line in reader:
+                invitation_num, serial_num = line
+                if invitation_num in links:
+                    logger.warning('Invitation number %s appears in links file multiple times' % invitation_num)
+                    continue
+                links[invitation_num] = serial_num
+        return links
+
+    @staticmethod
+    def match_invitation_num(accession_num, invitation_nums):
+        # Same as searching for '%invitation_num%', but starting from the accession number
+        for length in range(len(accession_num), 0, -1):
+            for start in range(len(accession_num) - length + 1):
+                candidate = accession_num[start:start + length]
+                if candidate in invitation_nums:
+                    return candidate
+        return None
+
+    def unlinked_links(self, links_file, delimiter=',', skip_first_line=False):
+        # Invitation numbers that are not linked to an accession number yet
+        links = self.load_links(links_file, delimiter, skip_first_line)
+        try:
+            self.db_lock.acquire()
+            serials = self.index.serials()
+        finally:
+            self.db_lock.release()
+        return dict((invitation_num, serial_num) for invitation_num, serial_num in links.items()
+                    if serial_num not in serials)
+
+    def link_accession_numbers(self, accession_numbers, links):
+        linked = []
+        for accession_num in set(accession_numbers):
+            invitation_num = self.match_invitation_num(accession_num, links)
+            if invitation_num is None:
+                continue
+            serial_num = links.pop(invitation_num)
+            try:
+                self.db_lock.acquire()
+                self.index.update(accession_num, serial_num)
+            finally:
+                self.db_lock.release()
+            linked.append((invitation_num, serial_num, accession_num))
+        return linked
+
+    def reload_links(self, links_file, delimiter=',', skip_first_line=False):
+        # Reads the links file if it changed since it was last read, and links the accession numbers
+        # that could not be linked before. Returns whether the file was read.
+        try:
+            st = os.stat(links_file)
+        except OSError as err:
+            if self.links_state is None:
+                raise
+            logger.error('Could not check links file %s: %s' % (links_file, err))
+            return False
+        state = (st.st_size, st.st_mtime_ns)
+        if state == self.links_state:
+            return False
+
+        try:
+            links = self.unlinked_links(links_file, delimiter, skip_first_line)
+        except (OSError, ValueError) as err:
+            if self.links_state is None:
+                raise
+            # Keep the links read before, until the file changes again
+            logger.error('Could not reload links file %s: %s' % (links_file, err))
+            self.links_state = state
+            return False
+
+        try:
+            self.db_lock.acquire()
+            unlinked = self.index.unlinked()
+        finally:
+            self.db_lock.release()
+        linked = self.link_accession_numbers(unlinked, links)
+        if self.links_state is not None:
+            logger.info('Links file %s changed, linked %d accession numbers' % (links_file, len(linked)))
+
+        self.links = links
+        self.links_state = state
+        return True
+
+    def relinked_files(self):
+        # Files that were quarantined because they were not linked, and are linked now
+        relinked = []
+        try:
+            self.db_lock.acquire()
+            for path, accession_num in list(self.unlinked_files.items()):
+                if self.index.get(accession_num) is not None:
+                    relinked.append(path)
+                    del self.unlinked_files[path]
+        finally:
+            self.db_lock.release()
+        return relinked
+
+    def watch(self, ident_dir, clean_dir, links_file, delimiter=',', skip_first_line=False, num_workers=1,
+              poll_interval=1.0, settle_time=2.0):
+        logger.info('Watching %s for new DICOM files' % ident_dir)
+
+        self.unlinked_files = {}
+        self.reload_links(links_file, delimiter, skip_first_line)
+
+        watcher = None
+        if InotifyWatcher.available():
+            try:
+                watcher = InotifyWatcher(ident_dir, poll_interval)
+            except OSError as err:
+                logger.warning('Could not use inotify, falling back to polling: %s' % err)
+        if watcher is None:
+            watcher = PollingWatcher(ident_dir, poll_interval)
+
+        processed = {}
+        observed = {}
+        pending = set()
+        candidates = None
+        try:
+            while True:
+                if candidates is None:
+                    candidates = set(FileListing.crawl(ident_dir, self.crawl_workers).paths())
+                pending.update(candidates)
+
+                if self.reload_links(links_file, delimiter, skip_first_line):
+                    # Files that were quarantined because they were not linked are processed again
+                    relinked = self.relinked_files()
+                    if relinked:
+                        logger.info('Processing %d quarantined files again, that are linked now' % len(relinked))
+                    for path in relinked:
+                        processed.pop(path, None)
+                        pending.add(path)
+
+                # A file is complete when its size and modification time have settled
+                ready = []
+                now = time.time()
+                for path in list(pending):
+                    try:
+                        st = os.stat(path)
+                    except OSError:
+                        pending.discard(path)
+                        observed.pop(path, None)
+                        continue
+                    key = (st.st_size, st.st_mtime)
+                    if processed.get(path) == key:
+                        pending.discard(path)
+                    elif observed.get(path) == key and now - st.st_mtime >= settle_time:
+                        ready.append((path, key))
+                        pending.discard(path)
+                        del observed[path]
+                    else:
+                        observed[path] = key
+
+                if ready:
+                    tasks = [os.path.split(path) for path, _ in ready]
+                    accession_numbers = []
+                    self.index_tasks(tasks, ident_dir, num_workers, accession_numbers)
+                    self.link_accession_numbers(accession_numbers, self.links)
+                    pseudonymized, prior, duplicates = self.run_tasks(tasks, ident_dir, clean_dir,
+                                                                      num_workers, skip_prior=True)
+                    logger.info('Pseudonymized %d of %d new DICOM files (%d skipped as pseudonymized before, '
+                                '%d as identical to another file)' % (pseudonymized, len(tasks), prior, duplicates))
+                    for path, key in ready:
+                        processed[path] = key
+
+                candidates = watcher.changes()
+        finally:
+            watcher.close()
+
+    def run_job(self, job):
+        ident_dir = os.path.abspath(job.get('ident_dir', self.server_ident_dir))
+        clean_dir = os.path.abspath(job.get('clean_dir', self.server_clean_dir))
+        skip_prior = job.get('skip_prior', True)
+
+        if 'files' in job:
+            # Files are pseudonymized and quarantined relative to ident_dir, so they must be in it
+            paths = [os.path.abspath(path) for path in job['files']]
+            outside = [path for path in paths if os.path.commonpath([ident_dir, path]) != ident_dir]
+            if outside:
+                raise ValueError('%d files are not in %s, such as %s' % (len(outside), ident_dir, outside[0]))
+            tasks = [os.path.split(path) for path in paths]
+        else:
+            tasks = FileListing.crawl(ident_dir, self.crawl_workers).tasks()
+
+        logger.info('Received job with %d files in %s' % (len(tasks), ident_dir))
+
+        # Only files with new accession numbers need to be linked
+        accession_numbers = []
+        self.index_tasks(tasks, ident_dir, self.server_num_workers, accession_numbers)
+        try:
+            self.links_lock.acquire()
+            self.reload_links(*self.server_links_file)
+            self.link_accession_numbers(accession_numbers, self.links)
+        finally:
+            self.links_lock.release()
+
+        pseudonymized, prior, duplicates = self.run_tasks(tasks, ident_dir, clean_dir,
+                                                          self.server_num_workers, skip_prior)
+        logger.info('Pseudonymized %d of %d DICOM files in %s' % (pseudonymized, len(tasks), ident_dir))
+
+        return {
+            'files': len(tasks),
+            'pseudonymized': pseudonymized,
+            'prior': prior,
+            'duplicates': duplicates,
+        }
+
+    def accept_jobs(self, ident_dir, clean_dir, links_file, delimiter=',', skip_first_line=False, num_workers=1):
+        # Defaults and shared state for run_job
+        self.server_ident_dir = os.path.abspath(ident_dir)
+        self.server_clean_dir = os.path.abspath(clean_dir)
+        self.server_num_workers = num_workers
+        self.server_links_file = (links_file, delimiter, skip_first_line)
+        self.reload_links(links_file, delimiter, skip_first_line)
+        self.links_lock = Lock()
+        self.worker_slots = BoundedSemaphore(num_workers)
+
+    def serve(self, socket_path, ident_dir, clean_dir, links_file, delimiter=',', skip_first_line=False,
+              num_workers=1):
+        if not hasattr(socketserver, 'ThreadingUnixStreamServer'):
+            raise Exception('Server mode requires UNIX domain sockets, which are not supported on this platform')
+
+        self.accept_jobs(ident_dir, clean_dir, links_file, delimiter, skip_first_line, num_workers)
+
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+
+        server = socketserver.ThreadingUnixStreamServer(socket_path, JobHandler)
+        server.daemon_threads = True
+        server.pseudon = self
+        logger.info('Listening for jobs on %s' % socket_path)
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+            os.remove(socket_path)
+
+    def plan_worker(self, queue, pbar, db_lock, counter_queue, links, pool=None):
+        counts = Counter()
+        reasons = Counter()
+        modalities = Counter()
+        linked = set()
+        unlinked = set()
+
+        while True:
+            if pool is not None and pool.should_retire():
+                counter_queue.put((counts, reasons, modalities, linked, unlinked))
+                break
+            task = queue.get()
+            if task is None:
+                counter_queue.put((counts, reasons, modalities, linked, unlinked))
+                break
+
+            root, filename = task
+            if self.watchdog is not None:
+                self.watchdog.begin(os.path.join(root, filename),
+                                    (None, queue, pbar, counter_queue, (counts, reasons, modalities, linked, unlinked),
+                                     pool))
+            try:
+                if filename.startswith('.'):
+                    continue
+                source_path = os.path.join(root, filename)
+                counts['files'] += 1
+
+                ds = None
+                try:
+                    if not self.is_dicom_file(source_path):
+                        raise InvalidDicomError
+                    ds = dcmread(source_path, stop_before_pixels=True)
+                except IOError:
+                    logger.error('Error reading file %s' % source_path)
+                    continue
+                except InvalidDicomError:  # DICOM formatting error
+                    reasons['Could not read DICOM file.'] += 1
+                    continue
+
+                if MODALITY in ds and ds[MODALITY].value:
+                    # Multiple modalities are counted together, as they are written in the header
+                    modality = ds[MODALITY]
+                    modalities['\\'.join(modality.value) if modality.VM > 1 else modality.value] += 1
+                else:
+                    modalities['(missing)'] += 1
+
+                move, reason = self.check_quarantine(ds)
+                if move:
+                    reasons[reason] += 1
+                    continue
+
+                accession_num = ds.AccessionNumber
+                if accession_num not in linked and accession_num not in unlinked:
+                    # Linked by an earlier run, or by this run to an invitation number in the links file
+                    try:
+                        db_lock.acquire()
+                        serial_num = self.index.get(accession_num)
+                    finally:
+                        db_lock.release()
+                    if serial_num is None and self.match_invitation_num(accession_num, links) is None:
+                        unlinked.add(accession_num)
+
+                if accession_num in unlinked:
+                    reasons['No serial number for accession number'] += 1
+                    continue
+
+                linked.add(accession_num)
+                counts['pseudonymized'] += 1
+                counts['bytes'] += os.path.getsize(source_path)
+            finally:
+                if self.watchdog is not None and not self.watchdog.end():
+                    return False
+                queue.task_done()
+                pbar.update()
+
+    def plan(self, ident_dir, links_file, delimiter=',', skip_first_line=False, num_workers=1):
+        """Report what a run would do, reading only the headers of the files
+        once. Accession numbers are linked to the links file the way the index
+        would link them, without building the index."""
+        logger.info('Planning pseudonymization of DICOM files')
+
+        links = self.unlinked_links(links_file, delimiter, skip_first_line)
+        counter_queue = Queue()
+        queue = Queue()
+        tasks = self.list_files(ident_dir).tasks()
+        file_count = len(tasks)
+        pbar = tqdm(total=file_count)
+        pbar.set_description('Planning files')
+
+        for task in tasks:
+            queue.put(task)
+
+        pool, autoscaler = self.start_workers(self.plan_worker, (queue, pbar, self.db_lock, counter_queue, links),
+                                              queue, pbar, num_workers)
+
+        queue.join()
+
+        self.stop_workers(pool, autoscaler)
+
+        pbar.close()
+
+        report = {
+            'counts': Counter(),
+            'reasons': Counter(),
+            'modalities': Counter(),
+            'linked': set(),
+            'unlinked': set(),
+        }
+        while True:
+            try:
+                counts, reasons, modalities, linked, unlinked = counter_queue.get_nowait()
+                report['counts'].update(counts)
+                report['reasons'].update(reasons)
+                report['modalities'].update(modalities)
+                report['linked'].update(linked)
+                report['unlinked'].update(unlinked)
+            except Empty:
+                break
+
+        counts = report['counts']
+        logger.info('Plan: %d of %d files will be pseudonymized, writing approximately %d bytes' %
+                    (counts['pseudonymized'], counts['files'], counts['bytes']))
+        for reason, count in report['reasons'].most_common():
+            logger.info('Plan: %d files will be moved to quarantine due to: %s' % (count, reason))
+        for modality, count in sorted(report['modalities'].items()):
+            logger.info('Plan: %d files with modality %s' % (count, modality))
+        logger.info('Plan: %d of %d accession numbers will be linked' %
+                    (len(report['linked']), len(report['linked']) + len(report['unlinked'])))
+
+        return report
+
     def clean_up(self):
         logger.info('Cleaning up index and database files')
         try:
-            os.remove(INDEXED_LOCK_FNAME)
+            # There is no lock file if the index was not built, as in single pass mode
+            if os.path.exists(INDEXED_LOCK_FNAME):
+                os.remove(INDEXED_LOCK_FNAME)
             os.remove(self.index_file)
         except OSError as err:
             logger.error(err)
@@ -699,6 +3056,20 @@ if __name__ == '__main__':
                         help='Skip first line in links file. Should be set if first line is a header. Defaults to false')
     parser.add_argument('-q', '--quarantine', type=str, default='quarantine',
                         help='Quarantine directory. Defaults to ./quarantine')
+    parser.add_argument('-r', '--quarantine_rules', type=str, default=None,
+                        help='Path to quarantine rules csv file. Defaults to the built-in rules')
+    parser.add_argument('-sr', '--quarantine_rules_skip_first_line', action='store_true', default=False,
+                        help='Skip first line in quarantine rules file. Should be set if first line is a header. Defaults to false')
+    parser.add_argument('-pm', '--pixel_masks', type=str, default=None,
+                        help='Path to csv file with regions of pixel data to blank per manufacturer, model and image size. '
+                             'Requires NumPy')
+    parser.add_argument('-sp', '--pixel_masks_skip_first_line', action='store_true', default=False,
+                        help='Skip first line in pixel masks file. Should be set if first line is a header. Defaults to false')
+    parser.add_argument('--uid_key_file', type=str, default=None,
+                        help='File with a secret key to replace UIDs with UIDs derived from it, instead of blanking them. '
+                             'Defaults to blanking the required UIDs and removing the others')
+    parser.add_argument('--uid_table', action='store_true', default=False,
+                        help='Store replaced UIDs in the index, and reuse them in later runs. Defaults to false')
     parser.add_argument('-i', '--index_file', type=str, default='index.db',
                         help='Name of sqlite index file. Default to index.db')
     parser.add_argument('-m', '--modalities', type=str, nargs='+', default=['mr', 'ct'],
@@ -707,7 +3078,59 @@ if __name__ == '__main__':
                         help='Name of file to log messages to. Defaults to console')
     parser.add_argument('-w', '--num_workers', type=int, default=1,
                         help='Amount of worker threads. Defaults to 1')
+    parser.add_argument('-mw', '--max_workers', type=int, default=None,
+                        help='Adapt the amount of worker threads to the workload, between --num_workers and this. '
+                             'Defaults to a fixed amount of workers')
+    parser.add_argument('-s', '--schedule', type=str, default='walk', choices=SCHEDULES,
+                        help='Order to process files in: walk (directory order) or size (largest first, '
+                             'interleaved with small files). Defaults to walk')
+    parser.add_argument('--screen_pixels', action='store_true', default=False,
+                        help='Quarantine images that appear to have text burnt into their pixel data. '
+                             'Requires NumPy. Defaults to false')
+    parser.add_argument('-p', '--plan', action='store_true', default=False,
+                        help='Only read headers and report what a run would do, without writing any files. Defaults to false')
+    parser.add_argument('--watch', action='store_true', default=False,
+                        help='Keep running and pseudonymize new files as they appear in ident_dir. Defaults to false')
+    parser.add_argument('--poll_interval', type=float, default=1.0,
+                        help='Seconds between checks for new files in watch mode. Defaults to 1')
+    parser.add_argument('-t', '--file_timeout', type=float, default=None,
+                        help='Seconds a single file may take. Files that take longer are quarantined, and their worker '
+                             'is replaced. Defaults to no limit')
+    parser.add_argument('--large_file_size', type=int, default=LARGE_FILE_SIZE,
+                        help='Size in megabytes from which files are streamed instead of read into memory. Defaults to %d' % LARGE_FILE_SIZE)
+    parser.add_argument('--deflate', action='store_true', default=False,
+                        help='Write uncompressed files as Deflated Explicit VR Little Endian. Defaults to false')
+    parser.add_argument('--deflate_level', type=int, default=DEFLATE_LEVEL,
+                        help='Compression level from 1 (fastest) to 9 (smallest) for --deflate. Defaults to %d' % DEFLATE_LEVEL)
+    parser.add_argument('--manifest', type=str, default=None,
+                        help='CSV file (or SQLite database, if the name ends with .db) to record every processed file in, '
+                             'instead of logging every quarantined file')
+    parser.add_argument('--listing', type=str, default=None,
+                        help='CSV file to save the list of files in ident_dir to, or to read it from if it exists. '
+                             'Can be shared with validate_dicom_pseudon.py. Defaults to listing ident_dir in every step')
+    parser.add_argument('--crawl_workers', type=int, default=CRAWL_WORKERS,
+                        help='Amount of threads listing directories. Defaults to %d' % CRAWL_WORKERS)
+    parser.add_argument('--profile', type=str, default=None, metavar='PREFIX',
+                        help='Profile the worker threads, and write PREFIX.prof (pstats), PREFIX.collapsed '
+                             '(collapsed stacks for flame graphs) and a table of hotspots to the log. Defaults to no profiling')
+    parser.add_argument('-k', '--keep_index', action='store_true', default=False,
+                        help='Keep the index after running, so that the next run only indexes new or changed files. Defaults to false')
+    parser.add_argument('--single_pass', action='store_true', default=False,
+                        help='Link accession numbers to the links file while pseudonymizing, instead of building '
+                             'the index first')
+    parser.add_argument('--cooperate', action='store_true', default=False,
+                        help='Share the work with other processes that use the same index and directories, which can be '
+                             'added while running. Does not prompt, and keeps the index')
+    parser.add_argument('--job', type=str, default=None,
+                        help='Identifier of the job to cooperate on. Defaults to one job per identified and cleaned '
+                             'directory')
+    parser.add_argument('--serve', type=str, default=None, metavar='SOCKET',
+                        help='Keep running and accept jobs from dicom_pseudon_client.py on this UNIX socket')
     args = parser.parse_args()
+    if args.file_timeout and (args.serve or args.watch):
+        # Abandoned workers would pile up in a process that keeps running, and a worker that is stuck
+        # while holding a lock stops the process, for all clients
+        parser.error('--file_timeout cannot be used with --serve or --watch')
     i_dir = args.ident_dir
     c_dir = args.clean_dir
     w_file = args.white_list_file
@@ -715,6 +3138,15 @@ if __name__ == '__main__':
     l_file_delim = args.links_delimiter
     l_file_skip_line = args.links_skip_first_line
     n_workers = args.num_workers
+    plan_only = args.plan
+    watch = args.watch
+    poll_interval = args.poll_interval
+    socket_path = args.serve
+    cooperate = args.cooperate
+    job = args.job
+    single_pass = args.single_pass
+    keep_index = args.keep_index
+    schedule = args.schedule
     del args.ident_dir
     del args.clean_dir
     del args.white_list_file
@@ -722,9 +3154,53 @@ if __name__ == '__main__':
     del args.links_delimiter
     del args.links_skip_first_line
     del args.num_workers
+    del args.plan
+    del args.watch
+    del args.poll_interval
+    del args.serve
+    del args.cooperate
+    del args.job
+    del args.single_pass
+    del args.keep_index
+    del args.schedule
 
     da = DicomPseudon(w_file, **vars(args))
 
+    if socket_path:
+        # Runs until interrupted, an existing index is reused without prompting
+        if not da.index_built():
+            da.build_index(i_dir, l_file, l_file_delim, l_file_skip_line, n_workers)
+        da.serve(socket_path, i_dir, c_dir, l_file, l_file_delim, l_file_skip_line, n_workers)
+
+    if cooperate:
+        # Other processes may still be using the index, so it is kept
+        if not da.index_built():
+            da.build_index(i_dir, l_file, l_file_delim, l_file_skip_line, n_workers)
+        da.cooperate(i_dir, c_dir, n_workers, schedule, job)
+        logger.info('Finished')
+        exit(0)
+
+    if watch:
+        # Runs until interrupted, the index is kept warm between batches
+        da.watch(i_dir, c_dir, l_file, l_file_delim, l_file_skip_line, n_workers, poll_interval)
+
+    if plan_only:
+        # Links are matched against the links file, so the index is not built
+        da.plan(i_dir, l_file, l_file_delim, l_file_skip_line, n_workers)
+        da.close_all()
+        logger.info('Finished')
+        exit(0)
+
+    if single_pass:
+        skip_prior_pseudonymized = False
+        if da.fingerprints_exist():
+            skip_prior_pseudonymized = da.prompt_skip_prior(i_dir)
+        da.run_single_pass(i_dir, c_dir, l_file, l_file_delim, l_file_skip_line, n_workers,
+                           skip_prior_pseudonymized, schedule)
+        if not keep_index:
+            da.clean_up()
+        logger.info('Finished')
+        exit(0)
     skip_build_index = False
     if da.index_built():
         skip_build_index = da.prompt_skip_build_index()
@@ -734,7 +3210,8 @@ if __name__ == '__main__':
     skip_prior_pseudonymized = False
     if da.fingerprints_exist():
         skip_prior_pseudonymized = da.prompt_skip_prior(i_dir)
-    da.run(i_dir, c_dir, n_workers, skip_prior_pseudonymized)
-    da.clean_up()
+    da.run(i_dir, c_dir, n_workers, skip_prior_pseudonymized, schedule)
+    if not keep_index:
+        da.clean_up()
 
     logger.info('Finished')
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# Dicom Pseudon - Python DICOM Pseudonymizer
+# Copyright (c) 2020  Mike Voets
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# Submits jobs to dicom_pseudon.py running with --serve. Only depends on the
+# standard library, so that submitting a job starts fast.
+
+import argparse
+import json
+import os
+import socket
+from sys import exit
+
+
+def submit(socket_path, job):
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(socket_path)
+        client.sendall((json.dumps(job) + '\n').encode('utf-8'))
+        with client.makefile('rb') as f:
+            return json.loads(f.readline().decode('utf-8'))
+    finally:
+        client.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument(dest='socket', type=str, help='Path to the socket of the server')
+    parser.add_argument(dest='files', type=str, nargs='*',
+                        help='Files to pseudonymize. Defaults to all files in the identified directory')
+    parser.add_argument('-i', '--ident_dir', type=str, default=None,
+                        help='Directory with identified files. Defaults to the directory of the server')
+    parser.add_argument('-c', '--clean_dir', type=str, default=None,
+                        help='Directory for pseudonymized files. Defaults to the directory of the server')
+    parser.add_argument('-a', '--all', action='store_true', default=False,
+                        help='Also pseudonymize files that have been pseudonymized before. Defaults to false')
+    args = parser.parse_args()
+
+    job = {'skip_prior': not args.all}
+    if args.files:
+        job['files'] = [os.path.abspath(path) for path in args.files]
+    if args.ident_dir:
+        job['ident_dir'] = os.path.abspath(args.ident_dir)
+    if args.clean_dir:
+        job['clean_dir'] = os.path.abspath(args.clean_dir)
+
+    result = submit(args.socket, job)
+    if 'error' in result:
+        print('Job failed: %s' % result['error'])
+        exit(1)
+
+    print('Pseudonymized %d of %d DICOM files' % (result['pseudonymized'], result['files']))
+    if result['prior'] > 0:
+        print('Skipped %d DICOM files because they were pseudonymized before' % result['prior'])
+    if result['duplicates'] > 0:
+        print('Skipped %d DICOM files because they were identical to another file' % result['duplicates'])
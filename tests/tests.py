@@ -16,11 +16,17 @@ import unittest
 import pydicom
 from pydicom.errors import InvalidDicomError
 import dicom_pseudon
+import validate_dicom_pseudon
 import csv
+import io
 import random
+import pstats
 import re
 import os
 import shutil
+import time
+from threading import Thread, Event, current_thread
+from queue import Queue
 
 # Backwards compability for secrets method in Python < 3.6
 try:
@@ -30,6 +36,12 @@ except ImportError:
     def token_hex(nbytes=None):
         return urandom(nbytes).hex()
 
+# Pixel screening and masking are optional, and need NumPy
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 
 ACCESSION_NUMBER = (0x8, 0x50)
 IMAGE_LATERALITY = (0x20, 0x62)
@@ -88,6 +100,18 @@ class TestDicomPseudon(unittest.TestCase):
         self.sernum = self.getSerialNumber("R9BF8PC1GE")
         self.pseu = pydicom.read_file("tests/clean/%s/1.dcm" % self.sernum)
 
+    def make_pseudon(self, **kwargs):
+        options = {
+            'white_list_skip_first_line': True,
+            'quarantine': "tests/quarantine",
+            'index_file': "tests/index.db",
+            'modalities': ["mg"],
+            'log_file': None,
+            'is_test': True,
+        }
+        options.update(kwargs)
+        return dicom_pseudon.DicomPseudon("tests/white_list.csv", **options)
+
     def tearDown(self):
         self.dp.clean_up()
         if os.path.isfile("tests/links.csv"):
@@ -132,6 +156,646 @@ class TestDicomPseudon(unittest.TestCase):
         self.assertTrue(self.pseu[IMAGE_LATERALITY].value is not None)
         self.assertTrue(self.pseu[IMAGE_LATERALITY].value.strip() != '')
 
+    def test_identicalFingerprintIsOnlyClaimedOnce(self):
+        in_flight = set()
+        self.assertTrue(self.dp.claim_fingerprint('d41d8cd98f00b204e9800998ecf8427e', in_flight))
+        self.assertFalse(self.dp.claim_fingerprint('d41d8cd98f00b204e9800998ecf8427e', in_flight))
+        self.assertTrue(self.dp.claim_fingerprint('d41d8cd98f00b204e9800998ecf8427e', set()))
+
+    def test_planDoesNotWriteFiles(self):
+        dp = self.make_pseudon(quarantine="tests/quarantine_plan")
+        report = dp.plan("tests/samples", "tests/links.csv", skip_first_line=True, num_workers=8)
+        dp.close_all()
+        self.assertTrue(report['counts']['pseudonymized'] > 0)
+        self.assertTrue("R9BF8PC1GE" in report['linked'])
+        self.assertFalse(os.path.exists("tests/quarantine_plan"))
+
+    def test_planLinksWithoutBuildingTheIndex(self):
+        dp = self.make_pseudon(index_file="tests/plan.db", quarantine="tests/quarantine_plan")
+        try:
+            report = dp.plan("tests/samples", "tests/links.csv", skip_first_line=True, num_workers=2)
+            self.assertTrue("R9BF8PC1GE" in report['linked'])
+            self.assertEqual(report['unlinked'], set())
+            self.assertFalse(dp.index.table_exists("accession_numbers"))
+        finally:
+            dp.close_all()
+            os.remove("tests/plan.db")
+
+    def test_planCountsMultipleModalities(self):
+        os.makedirs("tests/plan_multi")
+        try:
+            ds = pydicom.read_file("tests/samples/1/1_lbm/1.dcm")
+            ds.Modality = ["MG", "OT"]
+            ds.save_as("tests/plan_multi/1.dcm")
+            dp = self.make_pseudon(quarantine="tests/quarantine_plan")
+            report = dp.plan("tests/plan_multi", "tests/links.csv", skip_first_line=True, num_workers=1)
+            dp.close_all()
+            self.assertEqual(report['modalities']["MG\\OT"], 1)
+        finally:
+            shutil.rmtree("tests/plan_multi")
+
+    def test_pseudonymizeBytesInMemory(self):
+        dp = self.make_pseudon()
+        with open("tests/samples/1/1_lbm/1.dcm", "rb") as f:
+            data = f.read()
+        results = list(dp.pseudonymize_batch([data, b'not a dicom file']))
+        dp.close_all()
+
+        self.assertFalse(results[0].quarantined)
+        self.assertEqual(results[0].serial, self.sernum)
+        pseu = pydicom.dcmread(io.BytesIO(results[0].data))
+        self.assertEqual(pseu.AccessionNumber, self.sernum)
+        self.assertFalse(STATION_NAME in pseu)
+        self.assertTrue(results[1].quarantined)
+        self.assertTrue(results[1].data is None)
+
+    def test_indexIsBuiltIncrementally(self):
+        dp = self.make_pseudon()
+        sample_count = sum(len(files) for _, _, files in os.walk("tests/samples"))
+        self.assertEqual(len(dp.index.indexed_files()), sample_count)
+
+        dp.build_index("tests/samples", "tests/links.csv", skip_first_line=True, num_workers=8)
+        self.assertEqual(len(dp.index.indexed_files()), sample_count)
+        self.assertEqual(dp.index.get("R9BF8PC1GE"), self.sernum)
+        dp.close_all()
+
+    def test_incrementalBuildRetriesFilesAndReportsUnlinked(self):
+        with open("tests/links.csv", "a", newline="") as f:
+            csv.writer(f).writerow(["NOMATCH000", "nomatch_serial"])
+        sample_count = sum(len(files) for _, _, files in os.walk("tests/samples"))
+        dcmread = dicom_pseudon.dcmread
+
+        def failing(filepath, *args, **kwargs):
+            if str(filepath).endswith(os.path.join("a", "1.dcm")):
+                raise IOError("Failing on purpose")
+            return dcmread(filepath, *args, **kwargs)
+
+        dp = self.make_pseudon(index_file="tests/retry.db")
+        try:
+            dicom_pseudon.dcmread = failing
+            try:
+                dp.build_index("tests/samples", "tests/links.csv", skip_first_line=True, num_workers=2)
+            finally:
+                dicom_pseudon.dcmread = dcmread
+            self.assertEqual(len(dp.index.indexed_files()), sample_count - 1)
+
+            with self.assertLogs('dicom_pseudon', level='WARNING') as logs:
+                dp.build_index("tests/samples", "tests/links.csv", skip_first_line=True, num_workers=2)
+            self.assertEqual(len(dp.index.indexed_files()), sample_count)
+            self.assertTrue(any("invitation number NOMATCH000" in line for line in logs.output))
+        finally:
+            dp.close_all()
+            os.remove("tests/retry.db")
+
+    def test_singlePassLinksWhilePseudonymizing(self):
+        dp = self.make_pseudon(index_file="tests/single.db")
+        try:
+            dp.run_single_pass("tests/samples", "tests/clean_single", "tests/links.csv",
+                               skip_first_line=True, num_workers=8)
+            self.assertFalse(dp.single_pass_links)
+            pseu = pydicom.read_file("tests/clean_single/%s/1.dcm" % self.sernum)
+            self.assertEqual(pseu.AccessionNumber, self.sernum)
+            self.assertEqual(sorted(os.listdir("tests/clean_single")), sorted(os.listdir("tests/clean")))
+        finally:
+            dp.clean_up()
+            shutil.rmtree("tests/clean_single", ignore_errors=True)
+
+    def test_profileOfWorkersIsWritten(self):
+        dp = self.make_pseudon(profile="tests/profile")
+        try:
+            dp.run("tests/samples", "tests/clean_profile", num_workers=4)
+            stats = pstats.Stats("tests/profile.prof")
+            names = set(name for _, _, name in stats.stats)
+            self.assertTrue("buffer_fingerprint" in names)
+            self.assertTrue("save_as" in names)
+            self.assertTrue(os.path.isfile("tests/profile.collapsed"))
+        finally:
+            shutil.rmtree("tests/clean_profile", ignore_errors=True)
+            for filename in ("tests/profile.prof", "tests/profile.collapsed"):
+                if os.path.isfile(filename):
+                    os.remove(filename)
+
+    def test_largeFilesAreStreamed(self):
+        dp = self.make_pseudon(large_file_size=0)
+        try:
+            dp.run("tests/samples", "tests/clean_stream", num_workers=8)
+            pseu = pydicom.read_file("tests/clean_stream/%s/1.dcm" % self.sernum)
+            self.assertEqual(pseu.AccessionNumber, self.sernum)
+            self.assertFalse(STATION_NAME in pseu)
+            self.assertTrue(PIXEL_DATA in pseu)
+            self.assertEqual(len(pseu.PixelData), len(self.pseu.PixelData))
+        finally:
+            shutil.rmtree("tests/clean_stream", ignore_errors=True)
+
+    def test_deflatedFilesAreWritten(self):
+        dp = self.make_pseudon(deflate=True)
+        try:
+            dp.run("tests/samples", "tests/clean_deflate", num_workers=8)
+            pseu = pydicom.read_file("tests/clean_deflate/%s/1.dcm" % self.sernum)
+            self.assertEqual(pseu.file_meta.TransferSyntaxUID, pydicom.uid.DeflatedExplicitVRLittleEndian)
+            self.assertEqual(pseu.AccessionNumber, self.sernum)
+            self.assertEqual(len(pseu.PixelData), len(self.pseu.PixelData))
+        finally:
+            shutil.rmtree("tests/clean_deflate", ignore_errors=True)
+
+    def test_quarantineRulesFromFile(self):
+        with open("tests/quarantine_rules.csv", "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(['Tag', 'Predicate', 'Value', 'Reason'])
+            writer.writerow(['(0008,0050)', 'contains', 'r9bf8', 'Test rule'])
+            writer.writerow([])
+            writer.writerow(['ImageLaterality', 'missing', '', 'Laterality missing'])
+        try:
+            dp = self.make_pseudon(quarantine_rules="tests/quarantine_rules.csv", quarantine_rules_skip_first_line=True)
+            dp.close_all()
+            self.assertEqual(dp.check_quarantine(self.orig), (True, 'Test rule'))
+            self.assertEqual(dp.check_quarantine(self.pseu), (False, ''))
+
+            with open("tests/quarantine_rules.csv", "a", newline="") as f:
+                csv.writer(f).writerow(['Modality', 'missing'])
+            with self.assertRaisesRegex(Exception, 'line 5'):
+                dicom_pseudon.QuarantineRules.load("tests/quarantine_rules.csv", skip_first_line=True)
+        finally:
+            os.remove("tests/quarantine_rules.csv")
+
+    def test_manifestRecordsOutputs(self):
+        dp = self.make_pseudon(manifest="tests/manifest.csv")
+        try:
+            dp.run("tests/samples", "tests/clean_manifest", num_workers=8)
+            with open("tests/manifest.csv", "r") as f:
+                rows = list(csv.DictReader(f))
+            self.assertTrue(len(rows) > 0)
+            for row in rows:
+                if row['status'] == 'pseudonymized':
+                    self.assertEqual(row['output_hash'], dicom_pseudon.DicomPseudon.file_fingerprint(row['output_path']))
+        finally:
+            shutil.rmtree("tests/clean_manifest", ignore_errors=True)
+            os.remove("tests/manifest.csv")
+
+    def test_duplicatesAreOnlySkippedWithinARun(self):
+        dp = self.make_pseudon()
+        tasks = dicom_pseudon.FileListing.crawl("tests/samples").tasks()
+        try:
+            first = dp.run_tasks(tasks, "tests/samples", "tests/clean_again", num_workers=2)
+            second = dp.run_tasks(tasks, "tests/samples", "tests/clean_again", num_workers=2)
+            self.assertEqual(first, second)
+            self.assertTrue(second[0] > 0)
+            third = dp.run_tasks(tasks, "tests/samples", "tests/clean_again", num_workers=2, skip_prior=True)
+            self.assertEqual(third, (0, first[0], first[2]))
+        finally:
+            dp.close_all()
+            shutil.rmtree("tests/clean_again", ignore_errors=True)
+
+    def test_jobsOnlyAcceptFilesInIdentDir(self):
+        dp = self.make_pseudon()
+        dp.accept_jobs("tests/samples", "tests/clean_job", "tests/links.csv", skip_first_line=True)
+        walk_dicom = dp.walk_dicom
+
+        def failing(ident_dir, clean_dir, ds, source_path, *args):
+            if source_path.endswith("2.dcm"):
+                raise RuntimeError("Failing on purpose")
+            return walk_dicom(ident_dir, clean_dir, ds, source_path, *args)
+
+        dp.walk_dicom = failing
+        try:
+            with self.assertRaises(ValueError):
+                dp.run_job({'files': ["tests/white_list.csv", "tests/samples/1/1_lbm/1.dcm"]})
+            result = dp.run_job({'files': ["tests/samples/1/1_lbm/2.dcm", "tests/samples/1/1_lbm/1.dcm"],
+                                 'skip_prior': False})
+            self.assertEqual(result['files'], 2)
+            self.assertEqual(result['pseudonymized'], 1)
+        finally:
+            dp.close_all()
+            shutil.rmtree("tests/clean_job", ignore_errors=True)
+
+    def test_missingFilesDoNotStopJobs(self):
+        dp = self.make_pseudon()
+        dp.accept_jobs("tests/samples", "tests/clean_job", "tests/links.csv", skip_first_line=True)
+        try:
+            result = dp.run_job({'files': ["tests/samples/1/1_lbm/missing.dcm", "tests/samples/1/1_lbm/1.dcm"],
+                                 'skip_prior': False})
+            self.assertEqual(result['files'], 2)
+            self.assertEqual(result['pseudonymized'], 1)
+
+            # The index is still open for the next job
+            result = dp.run_job({'files': ["tests/samples/1/1_lbm/2.dcm"], 'skip_prior': False})
+            self.assertEqual(result['pseudonymized'], 1)
+        finally:
+            dp.close_all()
+            shutil.rmtree("tests/clean_job", ignore_errors=True)
+
+    def test_watchProcessesFilesAgainWhenLinksFileChanges(self):
+        class Stop(Exception):
+            pass
+
+        stopped = Event()
+
+        class StoppingWatcher(dicom_pseudon.PollingWatcher):
+            def changes(self):
+                if stopped.is_set():
+                    raise Stop()
+                return super(StoppingWatcher, self).changes()
+
+        def wait_for(path):
+            deadline = time.time() + 10
+            while not os.path.exists(path) and time.time() < deadline:
+                time.sleep(0.05)
+            return os.path.exists(path)
+
+        os.makedirs("tests/watched")
+        ds = pydicom.read_file("tests/samples/1/1_lbm/1.dcm")
+        ds.AccessionNumber = "WATCHED123456"
+        ds.save_as("tests/watched/watched.dcm")
+        with open("tests/watch_links.csv", "w", newline="") as f:
+            csv.writer(f).writerows([['Invitasjonsnummer', 'Loepenummer'], ['OTHER99', 'other_serial']])
+
+        available = dicom_pseudon.InotifyWatcher.available
+        polling_watcher = dicom_pseudon.PollingWatcher
+        dicom_pseudon.InotifyWatcher.available = staticmethod(lambda: False)
+        dicom_pseudon.PollingWatcher = StoppingWatcher
+        dp = self.make_pseudon(index_file="tests/watch.db")
+
+        def watch():
+            try:
+                dp.watch("tests/watched", "tests/clean_watch", "tests/watch_links.csv", skip_first_line=True,
+                         poll_interval=0.1, settle_time=0)
+            except Stop:
+                pass
+
+        thread = Thread(target=watch)
+        thread.daemon = True
+        thread.start()
+        try:
+            # Not linked yet, so the file is quarantined
+            self.assertTrue(wait_for("tests/quarantine/watched.dcm"))
+            self.assertFalse(os.path.exists("tests/clean_watch"))
+
+            time.sleep(0.2)
+            with open("tests/watch_links.csv", "a", newline="") as f:
+                csv.writer(f).writerow(['HED1234', 'watched_serial'])
+            self.assertTrue(wait_for("tests/clean_watch/watched_serial/1.dcm"))
+        finally:
+            stopped.set()
+            thread.join(10)
+            dicom_pseudon.InotifyWatcher.available = available
+            dicom_pseudon.PollingWatcher = polling_watcher
+            dp.close_all()
+            shutil.rmtree("tests/watched", ignore_errors=True)
+            shutil.rmtree("tests/clean_watch", ignore_errors=True)
+            os.remove("tests/watch_links.csv")
+            os.remove("tests/watch.db")
+
+    def test_scheduleBySizeStartsWithLargestFile(self):
+        tasks = [('a', '1'), ('a', '2'), ('a', '3'), ('a', '4')]
+        scheduled, sizes = dicom_pseudon.DicomPseudon.schedule_by_size(tasks, [10, 1000, 1, 100])
+        self.assertEqual(scheduled, [('a', '2'), ('a', '3'), ('a', '4'), ('a', '1')])
+        self.assertEqual(sizes, [1000, 1, 100, 10])
+        self.assertTrue(dicom_pseudon.DicomPseudon.estimate_makespan([10 ** 7, 10 ** 5, 10 ** 5, 10 ** 5], 2) <
+                        dicom_pseudon.DicomPseudon.estimate_makespan([10 ** 5, 10 ** 5, 10 ** 5, 10 ** 7], 2))
+
+    def test_workerPoolShrinksAndGrows(self):
+        queue = Queue()
+        done = []
+
+        def worker(pool):
+            while not pool.should_retire():
+                task = queue.get()
+                if task is None:
+                    break
+                done.append(task)
+                queue.task_done()
+
+        pool = dicom_pseudon.WorkerPool(worker, (), queue)
+        pool.start(3)
+        pool.shrink()
+        pool.shrink()
+        pool.shrink()  # The last worker is never retired
+        self.assertEqual(pool.active, 1)
+        pool.grow()
+        self.assertEqual(pool.active, 2)
+        for i in range(10):
+            queue.put(i)
+        queue.join()
+        pool.stop()
+        self.assertEqual(sorted(done), list(range(10)))
+
+    def test_autoscalerDecidesOnThroughputAndCpu(self):
+        pool = dicom_pseudon.WorkerPool(lambda pool: None, (), Queue())
+        pool.size = 2
+        autoscaler = dicom_pseudon.Autoscaler(pool, None, 1, 4)
+
+        # Files are waiting and the one CPU the workers can use is not saturated
+        self.assertEqual(autoscaler.decide(10.0, 10.0, 0.5, 8, None), 'grow')
+        # The workers keep the CPU busy
+        self.assertEqual(autoscaler.decide(10.0, 10.0, 0.95, 8, None), 'shrink')
+        # The added worker did not raise the throughput, so it is removed and growing waits
+        self.assertEqual(autoscaler.decide(10.2, 10.0, 0.5, 8, 'grow'), 'shrink')
+        self.assertEqual(autoscaler.decide(10.0, 10.0, 0.5, 8, 'shrink'), None)
+        # The added worker raised the throughput
+        autoscaler.cooldown = 0
+        self.assertEqual(autoscaler.decide(15.0, 10.0, 0.5, 8, 'grow'), 'grow')
+        pool.size = 4
+        self.assertEqual(autoscaler.decide(15.0, 10.0, 0.5, 8, None), None)
+
+    def test_listingIsSavedAndReused(self):
+        listing = dicom_pseudon.FileListing.crawl("tests/samples", 4)
+        walked = sorted((root, filename) for root, _, files in os.walk("tests/samples") for filename in files)
+        self.assertEqual(listing.tasks(), walked)
+        listing.save("tests/listing.csv")
+        try:
+            loaded = dicom_pseudon.FileListing.load("tests/listing.csv", "tests/samples")
+            self.assertEqual(loaded.entries, listing.entries)
+            self.assertIsNone(dicom_pseudon.FileListing.load("tests/listing.csv", "tests/clean"))
+        finally:
+            os.remove("tests/listing.csv")
+
+    def test_outdatedListingIsNotLoaded(self):
+        shutil.copytree("tests/samples", "tests/listed")
+        try:
+            dicom_pseudon.FileListing.crawl("tests/listed", 4).save("tests/listing.csv")
+            self.assertIsNotNone(dicom_pseudon.FileListing.load("tests/listing.csv", "tests/listed"))
+            # Directory times are not always precise to the sub-second
+            time.sleep(1.1)
+            shutil.copy("tests/samples/1/1_lbm/1.dcm", "tests/listed/2/a/3.dcm")
+            self.assertIsNone(dicom_pseudon.FileListing.load("tests/listing.csv", "tests/listed"))
+        finally:
+            shutil.rmtree("tests/listed")
+            os.remove("tests/listing.csv")
+
+    def test_symlinkedDirectoriesAreNotListed(self):
+        os.makedirs("tests/crawl/root")
+        os.makedirs("tests/crawl/other")
+        try:
+            shutil.copy("tests/samples/1/1_lbm/1.dcm", "tests/crawl/root/1.dcm")
+            shutil.copy("tests/samples/1/1_lbm/2.dcm", "tests/crawl/other/2.dcm")
+            try:
+                os.symlink(os.path.join("..", "other"), "tests/crawl/root/link")
+            except (OSError, NotImplementedError) as err:
+                self.skipTest("Symbolic links are not available: %s" % err)
+            listing = dicom_pseudon.FileListing.crawl("tests/crawl/root", 4)
+            walked = sorted((root, filename) for root, _, files in os.walk("tests/crawl/root") for filename in files)
+            self.assertEqual(listing.tasks(), walked)
+            self.assertEqual(listing.tasks(), [("tests/crawl/root", "1.dcm")])
+        finally:
+            shutil.rmtree("tests/crawl")
+
+    @unittest.skipIf(numpy is None, 'Pixel data requires NumPy')
+    def test_burntInTextIsDetected(self):
+        ds = pydicom.read_file("tests/samples/1/1_lbm/1.dcm")
+        y, x = numpy.mgrid[:256, :256]
+        image = numpy.clip(3000 - numpy.hypot(y - 128, x - 128) * 25, 0, None).astype(numpy.uint16)
+        ds.Rows, ds.Columns = 256, 256
+        ds.PixelData = image.tobytes()
+        screen = dicom_pseudon.PixelScreen()
+        self.assertEqual(screen.screen(ds), (False, ''))
+
+        # Letters in the top left corner
+        for left in range(8, 100, 12):
+            image[10:24, left:left + 2] = image[10:24, left + 6:left + 8] = image[16:18, left:left + 8] = 4095
+        ds.PixelData = image.tobytes()
+        self.assertEqual(screen.screen(ds), (True, 'Suspected burnt-in text'))
+
+    @unittest.skipIf(numpy is None, 'Pixel data requires NumPy')
+    def test_streamedFilesAreScreened(self):
+        os.makedirs("tests/screen/a")
+        try:
+            ds = pydicom.read_file("tests/samples/1/1_lbm/1.dcm")
+            y, x = numpy.mgrid[:256, :256]
+            image = numpy.clip(3000 - numpy.hypot(y - 128, x - 128) * 25, 0, None).astype(numpy.uint16)
+            ds.Rows, ds.Columns = 256, 256
+            ds.PixelData = image.tobytes()
+            ds.save_as("tests/screen/a/plain.dcm")
+            for left in range(8, 100, 12):
+                image[10:24, left:left + 2] = image[10:24, left + 6:left + 8] = image[16:18, left:left + 8] = 4095
+            ds.PixelData = image.tobytes()
+            ds.save_as("tests/screen/a/text.dcm")
+
+            dp = self.make_pseudon(screen_pixels=True, large_file_size=0)
+            dp.run("tests/screen", "tests/clean_screen", num_workers=2)
+            self.assertTrue(os.path.isfile("tests/quarantine/text.dcm"))
+            self.assertFalse(os.path.isfile("tests/quarantine/plain.dcm"))
+            self.assertEqual(len(os.listdir(os.path.join("tests/clean_screen", self.sernum))), 1)
+        finally:
+            shutil.rmtree("tests/screen")
+            shutil.rmtree("tests/clean_screen", ignore_errors=True)
+
+    @unittest.skipIf(numpy is None, 'Pixel data requires NumPy')
+    def test_allFramesAreScreened(self):
+        os.makedirs("tests/screen/a")
+        try:
+            ds = pydicom.read_file("tests/samples/1/1_lbm/1.dcm")
+            y, x = numpy.mgrid[:256, :256]
+            frames = numpy.repeat(numpy.clip(3000 - numpy.hypot(y - 128, x - 128) * 25, 0, None)
+                                  .astype(numpy.uint16)[numpy.newaxis], 4, axis=0)
+            # Letters in the top left corner of the third frame only
+            for left in range(8, 100, 12):
+                frames[2, 10:24, left:left + 2] = frames[2, 10:24, left + 6:left + 8] = 4095
+                frames[2, 16:18, left:left + 8] = 4095
+            ds.Rows, ds.Columns = 256, 256
+            ds.NumberOfFrames = "4"
+            ds.PixelData = frames.tobytes()
+            ds.save_as("tests/screen/a/cine.dcm")
+
+            for large_file_size in (None, 0):
+                options = {} if large_file_size is None else {'large_file_size': large_file_size}
+                dp = self.make_pseudon(screen_pixels=True, **options)
+                dp.run("tests/screen", "tests/clean_screen", num_workers=1)
+                self.assertTrue(os.path.isfile("tests/quarantine/cine.dcm"))
+                self.assertFalse(os.path.exists("tests/clean_screen"))
+                os.remove("tests/quarantine/cine.dcm")
+        finally:
+            shutil.rmtree("tests/screen")
+            shutil.rmtree("tests/clean_screen", ignore_errors=True)
+
+    @unittest.skipIf(numpy is None, 'Pixel data requires NumPy')
+    def test_pixelRegionsAreMaskedInAllFrames(self):
+        ds = pydicom.read_file("tests/samples/2/a/2.dcm")
+        original = ds.pixel_array.copy()
+        masks = dicom_pseudon.PixelMasks([[str(ds.get('Manufacturer', '')).upper(), str(ds.get('ManufacturerModelName', '')),
+                                           str(ds.Rows), str(ds.Columns), '0', '0', '10', '5']])
+        self.assertTrue(masks.mask(ds))
+        masked = ds.pixel_array
+        self.assertTrue((masked[:, :5, :10] == 0).all())
+        self.assertTrue((masked[:, 5:] == original[:, 5:]).all())
+        self.assertTrue((masked[:, :5, 10:] == original[:, :5, 10:]).all())
+
+        ds.Rows = 32
+        self.assertFalse(masks.mask(ds))
+
+    def test_uidsAreReplacedConsistently(self):
+        with open("tests/uid.key", "w") as f:
+            f.write(token_hex(32))
+        try:
+            dp = self.make_pseudon(uid_key_file="tests/uid.key")
+            first = pydicom.read_file("tests/samples/1/1_lbm/1.dcm")
+            second = pydicom.read_file("tests/samples/1/1_lbm/2.dcm")
+            sop_instance_uid = first.SOPInstanceUID
+            first = pydicom.dcmread(io.BytesIO(dp.pseudonymize_dataset(first).data))
+            second = pydicom.dcmread(io.BytesIO(dp.pseudonymize_dataset(second).data))
+        finally:
+            os.remove("tests/uid.key")
+
+        self.assertTrue(first.StudyInstanceUID.startswith("2.25."))
+        self.assertNotEqual(first.StudyInstanceUID, self.orig.StudyInstanceUID)
+        self.assertEqual(first.StudyInstanceUID == second.StudyInstanceUID,
+                         self.orig.StudyInstanceUID == pydicom.read_file("tests/samples/1/1_lbm/2.dcm").StudyInstanceUID)
+        self.assertEqual(first.file_meta.MediaStorageSOPInstanceUID, dp.uid_remapper.remap(sop_instance_uid))
+        self.assertEqual(first.file_meta.MediaStorageSOPClassUID, self.orig.file_meta.MediaStorageSOPClassUID)
+
+    def test_expiredWorkUnitsAreLeasedAgain(self):
+        index = dicom_pseudon.Index("tests/work.db")
+        try:
+            index.create_work_units("job", ['["a", "1"]', '["a", "2"]'])
+            index.create_work_units("job", ['["a", "3"]'])  # Units are only created once
+            self.assertEqual(index.remaining_work_units("job"), 2)
+
+            first = index.lease_work_unit("job", "first", 300)
+            second = index.lease_work_unit("job", "second", 300)
+            self.assertNotEqual(first[0], second[0])
+            self.assertIsNone(index.lease_work_unit("job", "third", 300))
+            index.db.execute("UPDATE work_units SET expires = 0 WHERE owner = 'second'")
+            self.assertEqual(index.lease_work_unit("job", "third", 300)[0], second[0])
+
+            self.assertTrue(index.complete_work_unit(first[0], "first"))
+            self.assertFalse(index.complete_work_unit(second[0], "second"))
+            self.assertTrue(index.complete_work_unit(second[0], "third"))
+            self.assertEqual(index.remaining_work_units("job"), 0)
+
+            # A later job on the same index gets its own units, and those of the finished job are removed
+            index.create_work_units("next", ['["b", "1"]'])
+            self.assertEqual(index.remaining_work_units("next"), 1)
+            self.assertEqual(index.lease_work_unit("next", "first", 300)[1], '["b", "1"]')
+            self.assertEqual(index.db.execute("SELECT COUNT(*) FROM work_units").fetchone()[0], 1)
+
+            # A job that is done is created again with the files listed by then
+            index.create_work_units("job", ['["a", "4"]'])
+            self.assertEqual(index.remaining_work_units("job"), 1)
+            self.assertEqual(index.lease_work_unit("job", "first", 300)[1], '["a", "4"]')
+        finally:
+            index.close()
+            os.remove("tests/work.db")
+
+    def test_unfinishedOutputIsNotCounted(self):
+        # A temporary file left by a process that crashed while writing
+        os.makedirs(os.path.join("tests/clean_again", self.sernum))
+        open(os.path.join("tests/clean_again", self.sernum, ".crashed.tmp"), "w").close()
+        try:
+            dp = self.make_pseudon()
+            dp.run("tests/samples", "tests/clean_again", num_workers=1)
+            names = sorted(os.listdir(os.path.join("tests/clean_again", self.sernum)))
+            self.assertEqual(names[:2], [".crashed.tmp", "1.dcm"])
+            self.assertFalse([name for name in names if name.endswith(".tmp") and name != ".crashed.tmp"])
+        finally:
+            shutil.rmtree("tests/clean_again", ignore_errors=True)
+
+    def test_filesThatTimeOutAreQuarantined(self):
+        dp = self.make_pseudon(file_timeout=0.5)
+        check_quarantine_header = dp.check_quarantine_header
+
+        def stuck(filepath):
+            if filepath.endswith(os.path.join("a", "1.dcm")):
+                time.sleep(3)
+            return check_quarantine_header(filepath)
+
+        dp.check_quarantine_header = stuck
+        shutil.rmtree("tests/quarantine")
+        started = time.time()
+        dp.run("tests/samples", "tests/clean", num_workers=2)
+        self.assertTrue(time.time() - started < 3)
+        self.assertEqual(dp.watchdog.timeouts, 1)
+        self.assertTrue(os.path.isfile("tests/quarantine/1.dcm"))
+
+    def test_indexingFilesThatTimeOutDoesNotStall(self):
+        dcmread = dicom_pseudon.dcmread
+
+        def stuck(filepath, *args, **kwargs):
+            if str(filepath).endswith(os.path.join("a", "1.dcm")):
+                time.sleep(3)
+            return dcmread(filepath, *args, **kwargs)
+
+        dp = self.make_pseudon(file_timeout=0.5, index_file="tests/timeout.db")
+        dicom_pseudon.dcmread = stuck
+        try:
+            started = time.time()
+            dp.build_index("tests/samples", "tests/links.csv", skip_first_line=True, num_workers=2)
+            self.assertTrue(time.time() - started < 3)
+            self.assertEqual(dp.watchdog.timeouts, 1)
+        finally:
+            dicom_pseudon.dcmread = dcmread
+            dp.close_all()
+            os.remove("tests/timeout.db")
+
+    def test_finishedFilesCannotTimeOut(self):
+        timed_out = []
+        watchdog = dicom_pseudon.Watchdog(0.2, lambda path, *args: timed_out.append(path))
+
+        watchdog.begin("finished.dcm", None)
+        self.assertTrue(watchdog.finish())
+        time.sleep(0.6)
+        self.assertEqual(timed_out, [])
+        self.assertTrue(watchdog.end())
+
+        watchdog.begin("stuck.dcm", None)
+        time.sleep(0.6)
+        self.assertFalse(watchdog.finish())
+        self.assertEqual(timed_out, ["stuck.dcm"])
+        self.assertFalse(watchdog.end())
+
+    def test_timedOutWorkersHoldingALockAreDetected(self):
+        dp = self.make_pseudon()
+        self.assertEqual(dp.held_locks(current_thread()), [])
+        with dp.db_lock:
+            self.assertEqual(dp.held_locks(current_thread()), ["index"])
+        self.assertEqual(dp.held_locks(current_thread()), [])
+
+    def make_validator(self, **kwargs):
+        return validate_dicom_pseudon.ValidateDicomPseudon("tests/white_list.csv", white_list_skip_first_line=True,
+                                                           log_file=None, **kwargs)
+
+    def test_validationSkipsUnchangedFiles(self):
+        validated = []
+
+        def counting(validator):
+            validate = validator.validate
+
+            def counted(ds):
+                validated.append(ds.filename)
+                return validate(ds)
+            validator.validate = counted
+            return validator
+
+        file_count = sum(len(files) for _, _, files in os.walk("tests/clean"))
+        try:
+            self.assertTrue(counting(self.make_validator(validated_file="tests/validated.db")).run("tests/clean"))
+            self.assertEqual(len(validated), file_count)
+            self.assertTrue(counting(self.make_validator(validated_file="tests/validated.db")).run("tests/clean"))
+            self.assertEqual(len(validated), file_count)
+
+            # A changed file is validated again
+            path = os.path.join("tests/clean", self.sernum, "1.dcm")
+            os.utime(path, (0, 0))
+            self.assertTrue(counting(self.make_validator(validated_file="tests/validated.db")).run("tests/clean"))
+            self.assertEqual(len(validated), file_count + 1)
+        finally:
+            os.remove("tests/validated.db")
+
+    def test_serialsAreCheckedAgainstIndex(self):
+        validator = self.make_validator(index_file="tests/index.db")
+        self.assertEqual(validator.check_serials({"a.dcm": self.sernum, "b.dcm": "R9BF8PC1GE"}), 1)
+        self.assertTrue(validator.run("tests/clean"))
+
+    def test_invalidFileMetaIsReported(self):
+        os.makedirs("tests/validate_meta")
+        try:
+            ds = pydicom.read_file(os.path.join("tests/clean", self.sernum, "1.dcm"))
+            ds.file_meta.SourceApplicationEntityTitle = "STATION"
+            ds.save_as("tests/validate_meta/1.dcm")
+            with open("tests/validate_meta/2.dcm", "wb") as f:
+                f.write(b"not a dicom file")
+            self.assertFalse(self.make_validator().run("tests/validate_meta", 1))
+        finally:
+            shutil.rmtree("tests/validate_meta")
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -19,20 +19,26 @@ import pydicom
 from pydicom.errors import InvalidDicomError
 from pydicom.tag import Tag
 from pydicom.dataelem import DataElement
-from functools import partial
 import shutil
 import argparse
 import os
 import csv
 import logging
 import re
+import sqlite3
 from signal import signal, SIGINT
 from sys import exit
 from threading import Thread, Lock
 from queue import Queue, Empty
 from tqdm import tqdm
+from dicom_pseudon import FileListing, Index, CRAWL_WORKERS
 
 
+VALIDATED_TABLE_NAME = 'validated_files'
+CREATE_VALIDATED_TABLE = 'CREATE TABLE IF NOT EXISTS %s (path PRIMARY KEY, size, mtime, accession_number)' % VALIDATED_TABLE_NAME
+INSERT_VALIDATED = 'INSERT OR REPLACE INTO %s (path, size, mtime, accession_number) VALUES (?, ?, ?, ?)' % VALIDATED_TABLE_NAME
+GET_VALIDATED = 'SELECT path, size, mtime, accession_number FROM %s' % VALIDATED_TABLE_NAME
+
 MEDIA_STORAGE_SOP_INSTANCE_UID = (0x2, 0x3)
 ACCESSION_NUMBER = (0x8, 0x50)
 SERIES_DESCR = (0x8, 0x103E)
@@ -104,10 +110,37 @@ logger = logging.getLogger('dicom_pseudon')
 logger.setLevel(logging.INFO)
 
 
+class ValidatedFiles(object):
+    """Pseudonymized files that passed validation, with their size and
+    modification time when they were validated, and their AccessionNumber."""
+
+    def __init__(self, filename):
+        self.db = sqlite3.connect(filename)
+        with self.db as db:
+            db.execute(CREATE_VALIDATED_TABLE)
+
+    def close(self):
+        self.db.close()
+
+    def files(self):
+        return dict((path, (size, mtime, accession_number))
+                    for path, size, mtime, accession_number in self.db.execute(GET_VALIDATED))
+
+    def insert(self, entries):
+        with self.db as db:
+            db.executemany(INSERT_VALIDATED, entries)
+
+
 class ValidateDicomPseudon(object):
     def __init__(self, white_list_file, **kwargs):
         self.white_list_file = white_list_file
         self.log_file = kwargs.get('log_file', 'dicom_pseudon.log')
+        self.listing_file = kwargs.get('listing', None)
+        self.crawl_workers = kwargs.get('crawl_workers', CRAWL_WORKERS)
+        self.validated_file = kwargs.get('validated_file', None)
+        self.index_file = kwargs.get('index_file', None)
+        if self.index_file and not os.path.isfile(self.index_file):
+            raise Exception('Could not open index file.')
         skip_first_line = kwargs.get('white_list_skip_first_line', False)
 
         try:
@@ -164,7 +197,7 @@ class ValidateDicomPseudon(object):
             return True
         return False
 
-    def validate_tags(self, ds, e):
+    def validate_tags(self, accession_num, e):
         white_listed = self.white_list_handler(e)
 
         if not white_listed:
@@ -172,33 +205,37 @@ class ValidateDicomPseudon(object):
             if REQUIRED_TAGS.get(t, None) or PIXEL_MODULE_TAGS.get(t, None) or ADDED_TAGS.get(t, None):
                 return True
             else:
-                logger.error('Tag %s not removed from file (AccessionNumber: %s)' % (t, ds.AccessionNumber))
+                logger.error('Tag %s not removed from file (AccessionNumber: %s)' % (t, accession_num))
                 return False
         return True
 
-    def validate_meta_tags(self, ds, e):
+    def validate_meta_tags(self, accession_num, e):
         white_listed = self.white_list_handler(e)
 
         if ALLOWED_FILE_META.get((e.tag.group, e.tag.element), None):
             return True
         if not white_listed:
-            logger.error('Tag %s not removed from file (AccessionNumber: %s)' % (t, ds.AccessionNumber))
+            logger.error('Tag %s not removed from file (AccessionNumber: %s)' %
+                         ((e.tag.group, e.tag.element), accession_num))
             return False
         return True
 
     def validate(self, ds):
-        ds.file_meta.walk(self.validate_meta_tags)
-        ds.walk(partial(self.validate_tags))
+        # Returns whether all tags are valid. The file meta and sequence items have no AccessionNumber of their own
+        results = []
+        accession_num = ds.get('AccessionNumber', None)
+        ds.file_meta.walk(lambda meta, e: results.append(self.validate_meta_tags(accession_num, e)))
+        ds.walk(lambda dataset, e: results.append(self.validate_tags(accession_num, e)))
 
-        return ds
+        return all(results)
 
-    def run_worker(self, queue, pbar):
+    def run_worker(self, queue, pbar, results):
         while True:
             task = queue.get()
             if task is None:
                 break
 
-            root, filename = task
+            root, filename, size, mtime = task
             try:
                 if filename.startswith('.'):
                     continue
@@ -208,27 +245,72 @@ class ValidateDicomPseudon(object):
                     ds = pydicom.read_file(source_path)
                 except IOError:
                     logger.error('Error reading file %s' % source_path)
-                    self.close_all()
-                    return False
-                self.validate(ds)
+                    results.append((os.path.abspath(source_path), size, mtime, None, False))
+                    continue
+                except InvalidDicomError:  # DICOM formatting error
+                    logger.error('Could not read DICOM file %s' % source_path)
+                    results.append((os.path.abspath(source_path), size, mtime, None, False))
+                    continue
+                valid = self.validate(ds)
+                results.append((os.path.abspath(source_path), size, mtime, ds.get('AccessionNumber', None), valid))
+            except Exception as err:
+                logger.error('Error validating file %s: %s' % (os.path.join(root, filename), err))
+                results.append((os.path.abspath(os.path.join(root, filename)), size, mtime, None, False))
             finally:
                 queue.task_done()
                 pbar.update()
 
+    def check_serials(self, accession_numbers):
+        # Every AccessionNumber should be a serial number from the links file
+        index = Index(self.index_file)
+        try:
+            serials = index.serials()
+        finally:
+            index.close()
+
+        unknown = 0
+        for path, accession_number in sorted(accession_numbers.items()):
+            if accession_number not in serials:
+                logger.error('AccessionNumber %s of file %s is not a known serial number' % (accession_number, path))
+                unknown += 1
+        return unknown
+
     def run(self, clean_dir, num_workers=1):
         logger.info('Validating pseudonymized DICOM files')
 
         queue = Queue()
-        file_count = sum(len(files) for _, _, files in os.walk(clean_dir))
-        pbar = tqdm(total=file_count)
+        listing = None
+        if self.listing_file:
+            listing = FileListing.load(self.listing_file, clean_dir)
+        if listing is None:
+            listing = FileListing.crawl(clean_dir, self.crawl_workers)
+            if self.listing_file:
+                listing.save(self.listing_file)
+        file_count = len(listing)
+
+        # Only files that are new or have changed since they were last validated are read
+        validated = {}
+        if self.validated_file:
+            validated_files = ValidatedFiles(self.validated_file)
+            validated = validated_files.files()
+        accession_numbers = {}
+        tasks = []
+        for root, filename, size, mtime in listing.entries:
+            path = os.path.abspath(os.path.join(root, filename))
+            known = validated.get(path)
+            if known is not None and known[:2] == (size, mtime):
+                accession_numbers[path] = known[2]
+            else:
+                tasks.append((root, filename, size, mtime,))
 
-        for root, _, files in os.walk(clean_dir):
-            for filename in files:
-                queue.put((root, filename,))
+        pbar = tqdm(total=len(tasks))
+        for task in tasks:
+            queue.put(task)
 
+        results = []
         threads = []
         for _ in range(num_workers):
-            t = Thread(target=self.run_worker, args=(queue, pbar,))
+            t = Thread(target=self.run_worker, args=(queue, pbar, results,))
             threads.append(t)
             t.daemon = True
             t.start()
@@ -241,9 +323,29 @@ class ValidateDicomPseudon(object):
             t.join()
 
         pbar.close()
-        logger.info('Validated %s pseudonymized DICOM files' % file_count)
+        logger.info('Validated %s pseudonymized DICOM files' % len(tasks))
+        if file_count > len(tasks):
+            logger.info('Skipped %d files that were validated before and have not changed' % (file_count - len(tasks)))
+
+        for path, _, _, accession_number, _ in results:
+            accession_numbers[path] = accession_number
+        invalid = len([result for result in results if not result[4]])
+        if invalid > 0:
+            logger.error('%d files did not pass validation' % invalid)
+
+        if self.validated_file:
+            # Invalid files are validated again on the next run
+            validated_files.insert([result[:4] for result in results if result[4]])
+            validated_files.close()
+
+        unknown = 0
+        if self.index_file:
+            unknown = self.check_serials(accession_numbers)
+            logger.info('Checked the AccessionNumber of %d files against the index, %d are not a known serial number' %
+                        (len(accession_numbers), unknown))
+
         self.close_all()
-        return True
+        return invalid == 0 and unknown == 0
 
 
 def exit_handler(signal_received, frame):
@@ -263,6 +365,17 @@ if __name__ == '__main__':
                         help='Name of file to log messages to. Defaults to console')
     parser.add_argument('-w', '--num_workers', type=int, default=1,
                         help='Amount of worker threads. Defaults to 1')
+    parser.add_argument('-v', '--validated_file', type=str, default=None,
+                        help='SQLite file to record validated files in, so that only new or changed files are validated '
+                             'on the next run. Defaults to validating all files')
+    parser.add_argument('-i', '--index_file', type=str, default=None,
+                        help='Index of dicom_pseudon.py (kept with -k), to check that every AccessionNumber is a known '
+                             'serial number. Defaults to not checking')
+    parser.add_argument('--listing', type=str, default=None,
+                        help='CSV file to save the list of files in clean_dir to, or to read it from if it exists. '
+                             'Can be shared with dicom_pseudon.py. Defaults to listing clean_dir on every run')
+    parser.add_argument('--crawl_workers', type=int, default=CRAWL_WORKERS,
+                        help='Amount of threads listing directories. Defaults to %d' % CRAWL_WORKERS)
     args = parser.parse_args()
     c_dir = args.clean_dir
     w_file = args.white_list_file